@@ -0,0 +1,357 @@
+"""
+AsyncSWM: asyncio counterpart of swm.SWM
+
+There are no read and write threads: the connection is served by the event
+loop. Ethernet uses asyncio streams, serial uses the file descriptor of the
+serial port with loop.add_reader, MockSerial answers directly on write and a
+replay hands out the recorded frames that are due every TICK.
+
+Commands can be awaited until the matching reply ($NN) arrives:
+
+    wheel = AsyncSWM(connection.Connection.from_file('default_mock.json'))
+    await wheel.connect()
+    pid = await wheel.command('$50')  # ['$50', '0', '1', ...]
+    await wheel.disconnect()
+"""
+import asyncio
+import logging
+import time
+
+from collections import defaultdict, deque, OrderedDict
+
+import connection
+
+from mock_serial import MockSerial
+from poll_scheduler import PollScheduler
+from replay_serial import ReplaySerial
+from swm import SWM, parse_frame, slugify
+from telemetry import DECODERS
+
+logger = logging.getLogger(__name__)
+
+
+class StreamTransport(object):
+    """
+    Ethernet connection using asyncio streams.
+    """
+    CR = '\r\n'
+    READ_SIZE = 4096
+
+    def __init__(self, conf, on_frame):
+        self.conf = conf
+        self.on_frame = on_frame
+        self.reader = None
+        self.writer = None
+        self._read_task = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.conf.ip_address, int(self.conf.ethernet_port))
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        current_read = bytearray()
+        while True:
+            data = await self.reader.read(self.READ_SIZE)
+            if not data:
+                break  # closed by remote
+            current_read += data
+            for frame in connection.split_frames(
+                    current_read, connection.SOCKET_FRAME_DELIMITERS):
+                self.on_frame(frame)
+
+    async def write(self, cmd):
+        self.writer.write(bytes(cmd + self.CR, 'UTF-8'))
+        await self.writer.drain()
+
+    async def close(self):
+        self._read_task.cancel()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+class SerialTransport(object):
+    """
+    Serial connection: the serial port file descriptor is watched by the event
+    loop, all frames are read as soon as data is ready.
+    """
+
+    def __init__(self, conf, on_frame):
+        self.conf = conf
+        self.on_frame = on_frame
+        self.serial = None
+
+    async def open(self):
+        # timeout=0: read_frames never blocks the event loop
+        self.serial = connection.SerialWrapper(
+            port=self.conf.comport, baudrate=self.conf.baudrate, timeout=0)
+        asyncio.get_running_loop().add_reader(self.serial.fileno(), self._readable)
+
+    def _readable(self):
+        for frame in self.serial.read_frames():
+            self.on_frame(frame)
+
+    async def write(self, cmd):
+        self.serial.write(cmd)
+
+    async def close(self):
+        asyncio.get_running_loop().remove_reader(self.serial.fileno())
+        self.serial.disconnect()
+
+
+class MockTransport(object):
+    """
+    MockSerial: it does not have a file descriptor, but it answers as soon as
+    something is written.
+    """
+
+    def __init__(self, conf, on_frame):
+        self.conf = conf
+        self.on_frame = on_frame
+        self.serial = None
+
+    async def open(self):
+        self.serial = MockSerial(timeout=self.conf.timeout)
+
+    async def write(self, cmd):
+        self.serial.write(cmd)
+        for frame in self.serial.read_frames():
+            self.on_frame(frame)
+
+    async def close(self):
+        self.serial.disconnect()
+
+
+class ReplayTransport(object):
+    """
+    ReplaySerial: no file descriptor either, the frames that are due are
+    handed out every TICK. Commands have no effect.
+    """
+    TICK = 0.01
+
+    def __init__(self, conf, on_frame):
+        self.conf = conf
+        self.on_frame = on_frame
+        self.serial = None
+        self._read_task = None
+
+    async def open(self):
+        self.serial = ReplaySerial(
+            self.conf.replay_filename, speed=self.conf.replay_speed,
+            loop=self.conf.replay_loop, timeout=self.conf.timeout)
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        while True:
+            # without timeout read_frames does not block the event loop
+            frames = self.serial.read_frames()
+            for frame in frames:
+                self.on_frame(frame)
+            # as fast as possible: let the loop breathe between batches
+            await asyncio.sleep(0 if frames and self.serial.speed <= 0 else self.TICK)
+
+    async def write(self, cmd):
+        self.serial.write(cmd)
+
+    async def close(self):
+        self._read_task.cancel()
+        self.serial.disconnect()
+
+
+TRANSPORTS = {
+    connection.ConnectionConfig.CONNECTION_TYPE_ETHERNET: StreamTransport,
+    connection.ConnectionConfig.CONNECTION_TYPE_SERIAL: SerialTransport,
+    connection.ConnectionConfig.CONNECTION_TYPE_MOCK: MockTransport,
+    connection.ConnectionConfig.CONNECTION_TYPE_REPLAY: ReplayTransport,
+}
+
+
+class AsyncSWM(object):
+    """
+    Smart Wheel Module: asyncio binding
+
+    Uses the same Connection (config) objects and command codes as SWM.
+    Replies are stored in cmd_from_wheel and decoded into telemetry, just like
+    SWM does.
+
+    command() returns the reply to the command; replies are matched on
+    command code, in order.
+    """
+    COMMAND_TIMEOUT = 1.0
+
+    def __init__(self, connection, update_period=.1, populate_incoming=False):
+        """
+        connection: connection.Connection object, only conf is used.
+        update_period in seconds: poll info at this rate, see start_polling
+
+        populate_incoming: put all replies in a queue, get them using read()
+        """
+        self.connection = connection
+        self.update_period = update_period
+        self.populate_incoming = populate_incoming
+
+        self.transport = None
+        self._poll_task = None
+
+        # last answers from wheel per command. key is command code, i.e. '$13'
+        self.cmd_from_wheel = {}
+        self.telemetry = {}
+        self.decode_errors = 0
+        self.cmd_counters = defaultdict(int)
+        self.total_reads = 0
+        self.total_writes = 0
+
+        # command code -> futures of commands waiting for their reply
+        self._waiting = defaultdict(deque)
+        self.incoming = asyncio.Queue()
+
+    @classmethod
+    def from_config(cls, filename, **kwargs):
+        """
+        Use a config filename to instantiate an AsyncSWM.
+        """
+        conn = connection.Connection.from_file(filename)
+        return cls(conn, **kwargs)
+
+    @property
+    def name(self):
+        return self.connection.conf.name
+
+    @property
+    def extra(self):
+        """
+        return dict which can be used in logger.info(msg, extra=...)
+        """
+        return dict(wheel_name=self.name, wheel_slug=slugify(self.name))
+
+    def __str__(self):
+        return '{wheel_name} [{wheel_slug}]'.format(**self.extra)
+
+    def is_connected(self):
+        return self.transport is not None
+
+    async def connect(self):
+        """
+        Open the connection using the transport for the connection type.
+
+        Raise ValueError if there is no transport for the connection type.
+        """
+        logger.info("going to connect to connection!!", extra=self.extra)
+        connection_type = self.connection.conf.connection_type
+        transport_cls = TRANSPORTS.get(connection_type)
+        if transport_cls is None:
+            raise ValueError('AsyncSWM does not support connection type [%s]' % connection_type)
+        transport = transport_cls(self.connection.conf, self.handle_read)
+        await transport.open()
+        self.transport = transport
+
+    async def disconnect(self):
+        """
+        Stop polling, close the connection and cancel all waiting commands.
+        """
+        self.stop_polling()
+        transport = self.transport
+        self.transport = None
+        self.cmd_from_wheel = {}
+        self.telemetry = {}
+        for futures in self._waiting.values():
+            for future in futures:
+                future.cancel()
+        self._waiting.clear()
+        if transport is not None:
+            await transport.close()
+
+    def handle_read(self, new_read):
+        """
+        Handle a single frame from the wheel, resolve waiting commands.
+        """
+        logger.debug("Read: %s" % new_read, extra=self.extra)
+        for reply in parse_frame(new_read, SWM.SEPARATOR):
+            code = reply[0]
+            self.cmd_from_wheel[code] = reply
+            self.cmd_counters[code] += 1
+            self.total_reads += 1
+            decoder = DECODERS.get(code)
+            if decoder is not None:
+                try:
+                    self.telemetry[code] = decoder(reply)
+                except (ValueError, IndexError):
+                    self.decode_errors += 1
+                    logger.warning("Could not decode: %s" % new_read, extra=self.extra)
+            if self.populate_incoming:
+                self.incoming.put_nowait(reply)
+            futures = self._waiting.get(code)
+            while futures:
+                future = futures.popleft()
+                if not future.done():
+                    future.set_result(reply)
+                    break
+
+    async def command(self, cmd, wait_reply=True, timeout=COMMAND_TIMEOUT):
+        """
+        Send cmd, return the reply or None if wait_reply is False.
+
+        Raise asyncio.TimeoutError if there is no reply within timeout seconds.
+        """
+        if self.transport is None:
+            raise connection.NotConnectedException("you're not connected. try connecting first.")
+        future = None
+        if wait_reply:
+            code = cmd.split(',')[0].strip()
+            future = asyncio.get_running_loop().create_future()
+            self._waiting[code].append(future)
+        await self.transport.write(cmd)
+        self.total_writes += 1
+        if future is None:
+            return None
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if future.cancelled():  # timeout
+                try:
+                    self._waiting[code].remove(future)
+                except ValueError:
+                    pass
+
+    async def read(self):
+        """
+        Return the next reply from the wheel, only if populate_incoming.
+        """
+        return await self.incoming.get()
+
+    async def enable(self, timeout=COMMAND_TIMEOUT):
+        return await self.command(SWM.CMD_ENABLE, timeout=timeout)
+
+    async def disable(self, timeout=COMMAND_TIMEOUT):
+        return await self.command(SWM.CMD_DISABLE, timeout=timeout)
+
+    async def reset(self, timeout=COMMAND_TIMEOUT):
+        return await self.command(SWM.CMD_RESET, timeout=timeout)
+
+    def start_polling(self):
+        """
+        Poll SWM.POLL_COMMANDS in a task, with the periods like SWM does.
+        """
+        if self._poll_task is None:
+            self._poll_task = asyncio.ensure_future(self._poll_loop())
+
+    def stop_polling(self):
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+
+    async def _poll_loop(self):
+        poll_once = dict(SWM.POLL_COMMANDS)
+        poll_periods = dict(self.connection.conf.poll_periods or {})
+        scheduler = PollScheduler(OrderedDict(
+            (poll_cmd, poll_periods.get(poll_cmd, SWM.POLL_PERIODS.get(poll_cmd, self.update_period)))
+            for poll_cmd, once in SWM.POLL_COMMANDS))
+        while True:
+            for poll_cmd in scheduler.due():
+                if poll_once[poll_cmd] and poll_cmd in self.cmd_from_wheel:
+                    continue
+                try:
+                    await self.command(poll_cmd, wait_reply=False)
+                except Exception:
+                    logger.exception('poll [%s] failed' % poll_cmd, extra=self.extra)
+            await asyncio.sleep(max(scheduler.next_due() - time.monotonic(), 0))
@@ -0,0 +1,325 @@
+"""
+bench.py
+
+End-to-end throughput and latency benchmark: N SWMs on mock connections send
+a mix of commands and the results are written as JSON, to compare releases.
+
+usage: bench.py [-h] [--wheels WHEELS] [--transport {mock,pty,ethernet}]
+                [--io {threads,engine}] [--duration DURATION] [--rate RATE]
+                [--mix MIX] [--no-poll] [--output OUTPUT]
+
+- mock: MockSerial connection
+- pty: MockSerial behind a pseudo terminal, using the real serial code path
+- ethernet: a server.py process per wheel (with a mock wheel) on localhost
+
+io threads gives every SWM its own read and write thread, io engine serves
+all wheels from a single IOEngine (SWMFleet).
+
+The command mix is a list of command codes with weights, i.e. 13:8,11:1,10:1
+(the default). Every wheel gets rate commands per second, all from a single
+driver thread.
+
+Reported:
+- commands_per_s: commands that got a reply, per second of the run
+- frames_per_s: frames read by all wheels, per second (including the polls)
+- latency_ms: p50, p99, p999 and max from SWM.command until the reply. With
+  polling on, a poll reply with the same code can answer a command.
+- timeouts: commands without a reply within SWM.COMMAND_TIMEOUT
+- missed_poll_steps: all wheels together
+- cpu_per_wheel: process CPU time / wall time / wheels (1.0 is a full core)
+- rss_kb: resident memory of the process at the end, if the platform can
+  tell (/proc or the resource module)
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import connection
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not on windows
+
+from bench_read import percentile
+from fleet import SWMFleet
+from mock_serial import MockSerialPty
+from swm import SWM
+
+DEFAULT_MIX = '13:8,11:1,10:1'
+# first port of the server.py processes for the ethernet transport
+ETHERNET_BASE_PORT = 5100
+SERVER_START_TIMEOUT = 10
+SERVER_STOP_TIMEOUT = 5
+
+
+def parse_mix(mix):
+    """
+    '13:8,11:1' -> [('$13', 8.0), ('$11', 1.0)]
+    """
+    result = []
+    for item in mix.split(','):
+        code, _, weight = item.partition(':')
+        code = code.strip()
+        if not code.startswith('$'):
+            code = '$' + code
+        result.append((code, float(weight or 1)))
+    return result
+
+
+def rss_kb():
+    """
+    Return current resident memory in kB, or the maximum if we cannot read it.
+    None if neither is available.
+    """
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on osx, kB on linux
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+
+def port_open(port):
+    """
+    Return True if something listens on localhost port.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        return probe.connect_ex(('127.0.0.1', port)) == 0
+
+
+class Transports(object):
+    """
+    Create connections for the wheels, and clean up the pty's and server.py
+    processes afterwards.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.ptys = []
+        self.servers = []
+        self.config_filenames = []
+
+    def connection(self, idx):
+        name = 'bench %s %d' % (self.transport, idx)
+        unique_address = idx + 1
+        if self.transport == 'pty':
+            pty = MockSerialPty()
+            self.ptys.append(pty)
+            return connection.Connection.from_dict({
+                'connection_type': 'serial', 'name': name, 'unique_address': unique_address,
+                'comport': pty.port, 'baudrate': 115200, 'timeout': 1})
+        if self.transport == 'ethernet':
+            port = ETHERNET_BASE_PORT + idx
+            self.start_server(idx, port)
+            return connection.Connection.from_dict({
+                'connection_type': 'ethernet', 'name': name, 'unique_address': unique_address,
+                'ip_address': '127.0.0.1', 'ethernet_port': str(port)})
+        return connection.Connection.from_dict({
+            'connection_type': 'mock', 'name': name, 'unique_address': unique_address})
+
+    def start_server(self, idx, port):
+        """
+        Start server.py with a mock wheel on port, wait until it listens.
+        """
+        if port_open(port):
+            raise IOError('port %d is already in use' % port)
+        config_file, config_filename = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(config_file, 'w') as f:
+            json.dump({
+                'connection_type': 'mock', 'name': 'bench server %d' % idx,
+                'unique_address': idx + 1}, f)
+        self.config_filenames.append(config_filename)
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+             '--host', '127.0.0.1', '--port', str(port), config_filename],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.servers.append(server)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if port_open(port):
+                return
+            time.sleep(0.1)
+        raise IOError('server.py did not start on port %d' % port)
+
+    def close(self):
+        for pty in self.ptys:
+            pty.disconnect()
+        for server in self.servers:
+            server.terminate()
+        for server in self.servers:
+            try:
+                server.wait(SERVER_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                # the mock wheel thread of server.py can keep it alive
+                server.kill()
+                server.wait()
+        for config_filename in self.config_filenames:
+            os.remove(config_filename)
+
+
+class CommandDriver(object):
+    """
+    Send commands from the mix to all wheels at rate commands per second per
+    wheel, and collect the command to reply latencies.
+    """
+
+    def __init__(self, smart_wheels, mix, rate):
+        self.smart_wheels = smart_wheels
+        self.codes = [code for code, weight in mix]
+        self.weights = [weight for code, weight in mix]
+        self.rate = rate
+        self.latencies = []
+        self.sent = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def done_fun(self, started):
+        def done(future):
+            try:
+                future.result()
+            except concurrent.futures.TimeoutError:
+                with self.lock:
+                    self.timeouts += 1
+                return
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+                return
+            latency = time.perf_counter() - started
+            with self.lock:
+                self.latencies.append(latency)
+        return done
+
+    def run(self, duration):
+        """
+        Send commands for duration seconds.
+        """
+        interval = 1.0 / (self.rate * len(self.smart_wheels))
+        start = time.perf_counter()
+        next_send = start
+        idx = 0
+        while True:
+            now = time.perf_counter()
+            if now - start >= duration:
+                break
+            if now < next_send:
+                time.sleep(next_send - now)
+            smart_wheel = self.smart_wheels[idx % len(self.smart_wheels)]
+            cmd = random.choices(self.codes, self.weights)[0]
+            started = time.perf_counter()
+            future = smart_wheel.command(cmd, reply=True)
+            future.add_done_callback(self.done_fun(started))
+            self.sent += 1
+            idx += 1
+            next_send += interval
+
+
+def run_benchmark(args):
+    transports = Transports(args.transport)
+    fleet = SWMFleet() if args.io == 'engine' else None
+    smart_wheels = []
+    try:
+        for idx in range(args.wheels):
+            conn = transports.connection(idx)
+            if fleet is not None:
+                smart_wheel = fleet.create(conn, poll_status=not args.no_poll)
+            else:
+                smart_wheel = SWM(conn, poll_status=not args.no_poll)
+            smart_wheels.append(smart_wheel)
+        for smart_wheel in smart_wheels:
+            smart_wheel.connect()
+        time.sleep(args.warmup)
+
+        driver = CommandDriver(smart_wheels, parse_mix(args.mix), args.rate)
+        reads_start = sum(smart_wheel.total_reads for smart_wheel in smart_wheels)
+        missed_start = sum(smart_wheel.missed_poll_steps for smart_wheel in smart_wheels)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        driver.run(args.duration)
+
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        reads = sum(smart_wheel.total_reads for smart_wheel in smart_wheels) - reads_start
+        missed = sum(smart_wheel.missed_poll_steps for smart_wheel in smart_wheels) - missed_start
+        memory = rss_kb()
+        # let the last replies come in
+        time.sleep(min(SWM.COMMAND_TIMEOUT, 1.0))
+    finally:
+        for smart_wheel in smart_wheels:
+            if smart_wheel.is_connected():
+                smart_wheel.disconnect()
+            smart_wheel.shut_down()
+        if fleet is not None:
+            fleet.shut_down()
+        transports.close()
+
+    latencies = sorted(driver.latencies)
+    result = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'wheels': args.wheels,
+        'commands_sent': driver.sent,
+        'commands_replied': len(latencies),
+        'timeouts': driver.timeouts,
+        'errors': driver.errors,
+        'commands_per_s': len(latencies) / wall,
+        'frames_per_s': reads / wall,
+        'missed_poll_steps': missed,
+        'cpu_per_wheel': cpu / wall / args.wheels,
+        }
+    if memory is not None:
+        result['rss_kb'] = memory
+    if latencies:
+        result['latency_ms'] = {
+            'p50': 1000 * percentile(latencies, 50),
+            'p99': 1000 * percentile(latencies, 99),
+            'p999': 1000 * percentile(latencies, 99.9),
+            'max': 1000 * latencies[-1],
+            }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SWM end-to-end benchmark.')
+    parser.add_argument('--wheels', type=int, default=4, help='number of wheels')
+    parser.add_argument('--transport', choices=['mock', 'pty', 'ethernet'], default='mock')
+    parser.add_argument('--io', choices=['threads', 'engine'], default='threads',
+                        help='own threads per wheel, or a shared IOEngine')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds after connect')
+    parser.add_argument('--rate', type=float, default=50, help='commands per second per wheel')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='command codes with weights')
+    parser.add_argument('--no-poll', action='store_true', help='do not poll the status')
+    parser.add_argument('--output', help='write JSON to this file instead of stdout')
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+bench_read.py
+
+Measure idle CPU usage and reply latency of the SWM read and write path.
+
+usage: bench_read.py [-h] [--transport {mock,pty}] [--idle IDLE] [--replies REPLIES]
+                     [--chunk-size CHUNK_SIZE]
+
+- mock: MockSerial connection
+- pty: MockSerial behind a pseudo terminal, using the real serial code path.
+  With --chunk-size, the frames arrive in chunks of that many bytes, 1 ms
+  apart (MockSerialPty.CHUNK_DELAY).
+
+Idle CPU is the CPU time of the whole process while a connected SWM is not
+polling, divided by wall time. The MockSerial update thread is included.
+Reply latency is the time from SWM.command until the reply is handled.
+"""
+import argparse
+import random
+import threading
+import time
+
+import connection
+
+from mock_serial import MockSerialPty
+from swm import SWM
+
+
+class ReplyTimingSWM(SWM):
+    """
+    SWM that signals reply_event every time a frame is handled.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.reply_event = threading.Event()
+        super(ReplyTimingSWM, self).__init__(*args, **kwargs)
+
+    def handle_read(self, new_read):
+        super(ReplyTimingSWM, self).handle_read(new_read)
+        self.reply_event.set()
+
+
+def percentile(values, pct):
+    """
+    Return percentile pct (0-100) of sorted list values.
+    """
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def measure_idle_cpu(smart_wheel, seconds):
+    """
+    Return process CPU time / wall time while smart_wheel is idle.
+    """
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    time.sleep(seconds)
+    return (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+
+def measure_reply_latency(smart_wheel, replies, cmd='$13'):
+    """
+    Return sorted list of command to reply times in seconds.
+    """
+    result = []
+    for i in range(replies):
+        smart_wheel.reply_event.clear()
+        time_start = time.perf_counter()
+        smart_wheel.command(cmd)
+        if smart_wheel.reply_event.wait(1):
+            result.append(time.perf_counter() - time_start)
+        # do not stay in phase with any loop in the read or write path
+        time.sleep(random.uniform(0.001, 0.02))
+    return sorted(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SWM read path benchmark.')
+    parser.add_argument('--transport', choices=['mock', 'pty'], default='mock')
+    parser.add_argument('--idle', type=float, default=5, help='idle measurement in seconds')
+    parser.add_argument('--replies', type=int, default=500, help='number of commands')
+    parser.add_argument('--chunk-size', type=int, help='pty: write frames in chunks of this size')
+    args = parser.parse_args()
+    if args.chunk_size and args.transport != 'pty':
+        parser.error('--chunk-size needs --transport pty')
+
+    pty = None
+    if args.transport == 'pty':
+        pty = MockSerialPty(chunk_size=args.chunk_size)
+        conn = connection.Connection.from_dict({
+            'connection_type': 'serial', 'name': 'bench pty', 'unique_address': 1,
+            'comport': pty.port, 'baudrate': 115200, 'timeout': 1})
+    else:
+        conn = connection.Connection.from_dict({
+            'connection_type': 'mock', 'name': 'bench mock', 'unique_address': 1})
+
+    smart_wheel = ReplyTimingSWM(conn, poll_status=False)
+    smart_wheel.connect()
+    time.sleep(0.5)
+
+    idle_cpu = measure_idle_cpu(smart_wheel, args.idle)
+    latencies = measure_reply_latency(smart_wheel, args.replies)
+
+    smart_wheel.shut_down()
+    smart_wheel.disconnect()
+    if pty is not None:
+        pty.disconnect()
+
+    print('transport:   %s' % args.transport)
+    if args.chunk_size:
+        print('chunk size:  %d' % args.chunk_size)
+    print('idle cpu:    %.2f %%' % (100 * idle_cpu))
+    print('replies:     %d/%d' % (len(latencies), args.replies))
+    if latencies:
+        print('latency ms:  p50=%.3f p99=%.3f max=%.3f' % (
+            1000 * percentile(latencies, 50), 1000 * percentile(latencies, 99),
+            1000 * latencies[-1]))
+
+
+if __name__ == '__main__':
+    main()
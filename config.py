@@ -116,6 +116,35 @@ class ConfigGUI(object):
         self.note.add(self.mock_frame, text=connection.ConnectionConfig.CONNECTION_TYPE_MOCK)
         self.note_idx[connection.ConnectionConfig.CONNECTION_TYPE_MOCK] = note_idx_counter
 
+        # replay tab
+        note_idx_counter += 1
+        self.replay_frame = ttk.Frame(self.note)
+
+        row = 0
+        ttk.Label(self.replay_frame, text="frame file or dir").grid(row=row, column=0)
+        self.replay_filename_var = tk.StringVar()
+        self.replay_filename_var.set("")
+
+        self.replay_filename = ttk.Entry(self.replay_frame, textvariable=self.replay_filename_var)
+        self.replay_filename.grid(row=row, column=1)
+
+        row += 1
+        ttk.Label(self.replay_frame, text="speed (0=max)").grid(row=row, column=0)
+        self.replay_speed_var = tk.StringVar()
+        self.replay_speed_var.set("1.0")
+
+        self.replay_speed = ttk.Entry(self.replay_frame, textvariable=self.replay_speed_var)
+        self.replay_speed.grid(row=row, column=1)
+
+        row += 1
+        self.replay_loop_var = tk.BooleanVar()
+        self.replay_loop_var.set(False)
+        ttk.Checkbutton(
+            self.replay_frame, text="loop", variable=self.replay_loop_var).grid(row=row, column=1, sticky=tk.W)
+
+        self.note.add(self.replay_frame, text=connection.ConnectionConfig.CONNECTION_TYPE_REPLAY)
+        self.note_idx[connection.ConnectionConfig.CONNECTION_TYPE_REPLAY] = note_idx_counter
+
         # lower part
         row += 1
         ttk.Label(mainframe, text="unique address").grid(
@@ -178,6 +207,11 @@ class ConfigGUI(object):
             self.unique_address_var.set(config.unique_address)
         elif config.connection_type == connection.ConnectionConfig.CONNECTION_TYPE_MOCK:
             self.unique_address_var.set(config.unique_address)
+        elif config.connection_type == connection.ConnectionConfig.CONNECTION_TYPE_REPLAY:
+            self.replay_filename_var.set(config.replay_filename)
+            self.replay_speed_var.set(config.replay_speed)
+            self.replay_loop_var.set(config.replay_loop)
+            self.unique_address_var.set(config.unique_address)
 
     def config_from_state(self):
         """Return config object from current window state"""
@@ -197,6 +231,15 @@ class ConfigGUI(object):
             config.set_var('unique_address', self.unique_address.get())
         elif connection_type == connection.ConnectionConfig.CONNECTION_TYPE_MOCK:
             config.set_var('unique_address', self.unique_address.get())
+        elif connection_type == connection.ConnectionConfig.CONNECTION_TYPE_REPLAY:
+            config.set_var('replay_filename', self.replay_filename.get())
+            config.set_var('replay_speed', self.replay_speed.get())
+            config.set_var('replay_loop', self.replay_loop_var.get())
+            config.set_var('unique_address', self.unique_address.get())
+
+        # not editable in this screen: keep them from the original config
+        if self.config_backup is not None and self.config_backup.poll_periods:
+            config.set_var('poll_periods', self.config_backup.poll_periods)
         return config
 
     def revert(self):
@@ -6,10 +6,11 @@ manage connections and connection configurations.
 ConnectionConfig: merely a set of variables that represent a connection
 Connection: using ConnectionConfig, set up and manage the connection.
 
-Currently 3 connection types are recognized:
+Currently 4 connection types are recognized:
 - serial: standard propeller connection
 - mock: testing responses in this software
 - ethernet (experimental using server.py)
+- replay: replay a recorded session (see recorder.py and replay_serial.py)
 
 also some wrappers to implement a single interface:
 - SocketWrapper implements socket with those functions
@@ -18,13 +19,18 @@ also some wrappers to implement a single interface:
 """
 import logging
 import json
+import os
+import re
+import select
 import serial
 import socket
 import time
 import threading
 
+from collections import deque
 from serial import Serial
 from mock_serial import MockSerial
+from replay_serial import ReplaySerial
 from socket import error as socket_error
 from socket import errno as socket_errno
 
@@ -34,35 +40,101 @@ logger = logging.getLogger(__name__)
 BAUDRATES = (9600, 19200, 38400, 57600, 115200, 230400, 250000)  
 
 
+# frames from the wheel are terminated by CR and/or LF
+FRAME_DELIMITERS = re.compile(b'[\r\n]+')
+# over ethernet, frames are also separated by SWM.SEPARATOR
+SOCKET_FRAME_DELIMITERS = re.compile(b'[\r\n|]+')
+
+
 class NotConnectedException(Exception):
     pass
 
 
+class ConnectionClosedException(IOError):
+    """
+    The other side closed the connection.
+    """
+    pass
+
+
+def split_frames(buf, delimiters=FRAME_DELIMITERS):
+    """
+    Split all complete frames from bytearray buf and return them decoded.
+
+    The incomplete tail stays behind in buf, so the next read can complete it.
+    Empty frames (i.e. from CR LF pairs) are filtered out.
+    """
+    if not delimiters.search(buf):
+        return []
+    parts = delimiters.split(buf)
+    buf[:] = parts.pop()  # the remainder, without delimiter
+    return [part.decode('UTF-8', 'replace') for part in parts if part]
+
+
 class SocketWrapper(socket.socket):
     """
     All the functions readline and write
+
+    Received data is collected in a preallocated buffer using recv_into, 
+    frames are reassembled on CR/LF and SWM.SEPARATOR.
     """
     CR = '\r\n'
+    RECV_BUFFER_SIZE = 4096
 
     def __init__(self, *args, **kwargs):
         super(SocketWrapper, self).__init__(*args, **kwargs)
         self.last_error = ''
+        self.recv_buffer = bytearray(self.RECV_BUFFER_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.current_read = bytearray()  # incomplete frame
+        self.frames = deque()  # complete frames, not yet returned by readline
+        self.bytes_read = 0
 
     def get_and_erase_last_error(self):
         result = self.last_error
         self.last_error = ''
         return result
 
-    def readline(self):
+    def read_frames(self, timeout=None):
+        """
+        Return a list with all complete frames, or [] if there is nothing.
+
+        timeout: wait at most timeout seconds for data. If None, block until 
+        something is received.
+
+        Raise ConnectionClosedException if the peer closed the connection.
+        """
+        frames = list(self.frames)
+        self.frames.clear()
         try:
-            result = self.recv(1024)
+            if timeout is not None:
+                readable, _, _ = select.select([self], [], [], 0 if frames else timeout)
+                if not readable:
+                    return frames
+            num_bytes = self.recv_into(self.recv_buffer)
         except socket_error as serr:
             self.last_error = 'connection error (%s).' % socket_errno.errorcode[serr.errno]
             raise serr
-        if result:
-            return result.decode('UTF-8')
-        else:
-            return result
+        if not num_bytes:
+            # readable without data: the peer closed the connection
+            if frames:
+                return frames  # raise next time
+            self.last_error = 'connection closed by peer.'
+            raise ConnectionClosedException(self.last_error)
+        self.bytes_read += num_bytes
+        self.current_read += self.recv_view[:num_bytes]
+        frames.extend(split_frames(self.current_read, SOCKET_FRAME_DELIMITERS))
+        return frames
+
+    def readline(self):
+        """
+        Return a single frame, or '' if there is no complete frame yet.
+        """
+        if not self.frames:
+            self.frames.extend(self.read_frames())
+        if self.frames:
+            return self.frames.popleft()
+        return ''
 
     def write(self, s):
         logging.debug('Writing [%s]...' % s)
@@ -73,7 +145,10 @@ class SocketWrapper(socket.socket):
             raise serr
 
     def disconnect(self):
-        self.shutdown(socket.SHUT_RDWR)
+        try:
+            self.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # already closed by the peer
         self.close()
 
 
@@ -81,8 +156,8 @@ class SerialWrapper(Serial):
     """
     Wrapper includes coding and decoding to/from utf-8
 
-    The readline function reads one character at a time, to prevent blocking
-    and losing messages.
+    read_frames drains everything that is waiting in one read, and returns all
+    complete frames at once. Incomplete frames are kept in a buffer.
     """
     CR = '\r\n'
 
@@ -90,50 +165,50 @@ class SerialWrapper(Serial):
         super(SerialWrapper, self).__init__(*args, **kwargs)
         #self.semaphore = threading.Semaphore()
         self.last_error = ''
-        self.current_read = ''  # buffer
+        self.current_read = bytearray()  # buffer
+        self.frames = deque()  # complete frames, not yet returned by readline
+        self.bytes_read = 0
 
     def get_and_erase_last_error(self):
         result = self.last_error
         self.last_error = ''
         return result
 
+    def read_frames(self, timeout=None):
+        """
+        Return a list with all complete frames, or [] if there is nothing.
+
+        All waiting bytes are read at once. If nothing is waiting, wait at most
+        timeout seconds for data; if timeout is None wait for a single byte, 
+        this takes at most the serial timeout.
+        """
+        frames = list(self.frames)
+        self.frames.clear()
+        waiting = self.in_waiting
+        if not waiting and timeout is not None and os.name == 'posix':
+            # on posix we can wait for the port without touching the serial timeout
+            select.select([self.fileno()], [], [], 0 if frames else timeout)
+            waiting = self.in_waiting
+            if not waiting:
+                return frames
+        data = super(SerialWrapper, self).read(waiting or 1)
+        if data:
+            self.bytes_read += len(data)
+            self.current_read += data
+            frames.extend(split_frames(self.current_read))
+        return frames
+
     def readline(self):
         """
-        Our readline reads a character at a time. This prevents problems as 
-        described below.
+        Return a single frame, or '' if there is no complete frame yet.
 
-        The readline command takes the amount of timeout time (1 second). And if 
-        during that time we use write command, the readline is stopped.
+        Use read_frames if you can handle multiple frames at once.
         """
-        #self.semaphore.acquire()
-        result = ''
-        #try:
-        # if 1:
-            #logger.info('jaaa')
-            #time_start = time.time()
-            #result = super(SerialWrapper, self).readline()  # takes 1 second
-
-        # read a character at a time: very fast
-        ch = super(SerialWrapper, self).read().decode('UTF-8')  
-        if ch == '\r' or ch == '\n':
-            result = self.current_read
-            self.current_read = ''
-        else:
-            self.current_read += ch 
-
-            #    logger.info('yea')
-            # logger.info('read ch: %s' % ch)
-            #logger.info("read time: %f" % (time.time() - time_start))
-        # except serial.serialutil.SerialException as e:
-        #     #self.semaphore.release()
-        #     self.last_error = str(e)
-        #     raise e
-        #self.semaphore.release()
-        # if result:
-        #     return result.decode('UTF-8')
-        # else:
-        #     return result
-        return result
+        if not self.frames:
+            self.frames.extend(self.read_frames())
+        if self.frames:
+            return self.frames.popleft()
+        return ''
 
     def write(self, s):
         #self.semaphore.acquire()
@@ -164,9 +239,11 @@ class ConnectionConfig(object):
     CONNECTION_TYPE_SERIAL = 'serial'
     CONNECTION_TYPE_MOCK = 'mock'
     CONNECTION_TYPE_ETHERNET = 'ethernet'
+    CONNECTION_TYPE_REPLAY = 'replay'
 
     CONNECTION_TYPES = [
-        CONNECTION_TYPE_SERIAL, CONNECTION_TYPE_MOCK, CONNECTION_TYPE_ETHERNET]
+        CONNECTION_TYPE_SERIAL, CONNECTION_TYPE_MOCK, CONNECTION_TYPE_ETHERNET,
+        CONNECTION_TYPE_REPLAY]
 
     def __init__(self):
         """Set default values. These values are to be changed."""
@@ -176,9 +253,16 @@ class ConnectionConfig(object):
         self.name = 'connection-name'
         self.ip_address = None
         self.ethernet_port = None
+        # replay: frame file or recorder wheel directory, speed (0 is as fast
+        # as possible) and start over at the end or not
+        self.replay_filename = ''
+        self.replay_speed = 1.0
+        self.replay_loop = False
         self.connection_type = self.CONNECTION_TYPE_SERIAL
         # integer id for externals to communicate with modules
         self.unique_address = 0  
+        # optional poll period in seconds per command, see SWM.POLL_PERIODS
+        self.poll_periods = None
 
     def as_dict(self):
         """representation of self as a dict for serialization purposes"""
@@ -203,6 +287,16 @@ class ConnectionConfig(object):
                 'name': name,  
                 'connection_type': self.connection_type,
                 'unique_address': self.unique_address}
+        elif self.connection_type == self.CONNECTION_TYPE_REPLAY:
+            result = {
+                'name': name,  
+                'connection_type': self.connection_type,
+                'replay_filename': self.replay_filename,
+                'replay_speed': self.replay_speed,
+                'replay_loop': self.replay_loop,
+                'unique_address': self.unique_address}
+        if result is not None and self.poll_periods:
+            result['poll_periods'] = self.poll_periods
         return result
 
     def save(self, filename):
@@ -264,6 +358,14 @@ class ConnectionConfig(object):
             self.set_var('unique_address', int(cfg['unique_address']))
         elif self.connection_type == self.CONNECTION_TYPE_MOCK:
             self.set_var('unique_address', int(cfg['unique_address']))
+        elif self.connection_type == self.CONNECTION_TYPE_REPLAY:
+            self.set_var('replay_filename', cfg['replay_filename'])
+            self.set_var('replay_speed', cfg.get('replay_speed', 1.0))
+            self.set_var('replay_loop', cfg.get('replay_loop', False))
+            self.set_var('unique_address', int(cfg['unique_address']))
+
+        if 'poll_periods' in cfg:
+            self.set_var('poll_periods', cfg['poll_periods'])
 
     def set_var(self, var_name, var_value):
         """
@@ -286,6 +388,15 @@ class ConnectionConfig(object):
             self.ethernet_port = var_value
         elif var_name == 'unique_address':
             self.unique_address = var_value
+        elif var_name == 'replay_filename':
+            self.replay_filename = var_value
+        elif var_name == 'replay_speed':
+            self.replay_speed = float(var_value)
+        elif var_name == 'replay_loop':
+            self.replay_loop = bool(var_value)
+        elif var_name == 'poll_periods':
+            self.poll_periods = dict(
+                (cmd, float(period)) for cmd, period in var_value.items())
         else:
             logger.error("Tried to set unknown variable: %s" % var_name)
 
@@ -302,6 +413,10 @@ class ConnectionConfig(object):
         elif self.connection_type == self.CONNECTION_TYPE_ETHERNET:
             return "ConnectionConfig [%s]: id=%s ethernet ip=%s port=%s" % (
                 self.name, self.unique_address, self.ip_address, self.ethernet_port)
+        elif self.connection_type == self.CONNECTION_TYPE_REPLAY:
+            return "ConnectionConfig [%s]: id=%s replay file=%s speed=%s loop=%s" % (
+                self.name, self.unique_address, self.replay_filename, self.replay_speed,
+                self.replay_loop)
 
 
 class Connection(object):
@@ -369,6 +484,14 @@ class Connection(object):
                 else:
                     self.last_error = 'connection error (%s).' % socket_errno.errorcode[serr.errno]
                 raise serr
+        elif self.conf.connection_type == ConnectionConfig.CONNECTION_TYPE_REPLAY:
+            try:
+                connection = ReplaySerial(
+                    self.conf.replay_filename, speed=self.conf.replay_speed,
+                    loop=self.conf.replay_loop, timeout=self.conf.timeout)
+            except IOError as ex:
+                self.last_error = str(ex)
+                raise
         # If all goes well.
         self.last_error = ''
         self.connection = connection
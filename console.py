@@ -8,16 +8,11 @@ usage: console.py [-h] [--port PORT] connection_config_filename
 """
 import argparse
 import signal
-import threading
 import sys
 
 from swm import SWM
-from time import sleep
-
-i_wanna_live = True
 
 if __name__ == '__main__':
-    global i_wanna_live
     print('smart wheel console')
     parser = argparse.ArgumentParser()
     parser.add_argument("connection_config_filename")
@@ -36,22 +31,15 @@ if __name__ == '__main__':
     print('connecting...')
     module.connect()
 
-    def worker():
-        global i_wanna_live
-        while i_wanna_live:
-            while module.incoming:
-                new_message = module.incoming.pop(0)
-                print('<- [%s]' % new_message)
-            sleep(0.01)
-    
-    t = threading.Thread(target=worker)
-    t.start()
+    def print_reply(smart_wheel, new_message, record):
+        print('<- [%s]' % new_message)
+
+    # called from the read thread for every reply
+    module.subscribe_replies(callback=print_reply)
 
     def term_handler(signal, frame):
-        global i_wanna_live
         print('shutting down...')
         module.shut_down()
-        i_wanna_live = False
         sys.exit(0)
 
     signal.signal(signal.SIGTERM, term_handler)
@@ -0,0 +1,314 @@
+"""
+SWMFleet: a set of SWMs that share a single IOEngine.
+
+All wheels in a fleet are served by the same I/O thread, which also does the
+polling for all of them (see io_engine.py). The fleet behaves like a list of
+SWMs and has operations for all wheels at once:
+
+    fleet = SWMFleet.from_config_files(['front_left.json', 'front_right.json'])
+    fleet.connect_all()
+    fleet.enable_all()
+    fleet.set_setpoints([(100, 0), (100, 0)])
+    fleet.dispatch_setpoints({1: (100, 0), 2: (100, 0)})  # in a single burst
+    fleet.speed_direction()  # [SpeedDirection(...), SpeedDirection(...)]
+    ...
+    fleet.shut_down()
+"""
+import logging
+import threading
+import time
+
+from collections import deque, namedtuple
+from contextlib import ExitStack
+
+import connection
+
+from io_engine import IOEngine
+from swm import SWM
+
+logger = logging.getLogger(__name__)
+
+
+# result of SWMFleet.dispatch_setpoints. sent: unique_address ->
+# time.perf_counter() after writing, failed: unique_addresses that could not
+# be written, skew: seconds between the first and the last write.
+SetpointDispatch = namedtuple('SetpointDispatch', 'started sent failed skew')
+
+
+class SWMFleet(object):
+    """
+    List of SWMs with a shared IOEngine.
+
+    Wheels are created with create (or from_config_files) so they use the
+    IOEngine. Fleet wide commands go to the connected wheels only and return
+    the wheels that got the command.
+
+    dispatch_setpoints writes setpoints directly to all connections at once and
+    measures the skew between the wheels, see dispatch_stats.
+    """
+    # number of dispatches kept for dispatch_stats
+    DISPATCH_HISTORY = 1000
+
+    def __init__(self, io_engine=None):
+        """
+        io_engine: IOEngine to use, by default the fleet starts its own.
+        """
+        self.own_io_engine = io_engine is None
+        self.io_engine = IOEngine() if io_engine is None else io_engine
+        self.smart_wheels = []
+
+        # only one dispatch at a time, write locks are taken in fleet order
+        self.dispatch_lock = threading.Lock()
+        self.last_dispatch = None
+        self.dispatch_skews = deque(maxlen=self.DISPATCH_HISTORY)
+
+    @classmethod
+    def from_config_files(cls, filenames, swm_class=SWM, **kwargs):
+        """
+        Create a fleet with a wheel for every connection config filename.
+
+        kwargs are passed to the swm_class constructor.
+        """
+        fleet = cls()
+        for filename in filenames:
+            fleet.create(connection.Connection.from_file(filename), swm_class=swm_class, **kwargs)
+        return fleet
+
+    def create(self, conn, swm_class=SWM, index=None, **kwargs):
+        """
+        Create a wheel (swm_class instance) for Connection conn that uses our
+        IOEngine and add it at index (default at the end). Return the wheel.
+        """
+        smart_wheel = swm_class(conn, io_engine=self.io_engine, **kwargs)
+        if index is None:
+            self.smart_wheels.append(smart_wheel)
+        else:
+            self.smart_wheels.insert(index, smart_wheel)
+        return smart_wheel
+
+    # list like behaviour
+    def __len__(self):
+        return len(self.smart_wheels)
+
+    def __iter__(self):
+        return iter(list(self.smart_wheels))
+
+    def __getitem__(self, idx):
+        return self.smart_wheels[idx]
+
+    def index(self, smart_wheel):
+        return self.smart_wheels.index(smart_wheel)
+
+    def insert(self, index, smart_wheel):
+        self.smart_wheels.insert(index, smart_wheel)
+
+    def append(self, smart_wheel):
+        self.smart_wheels.append(smart_wheel)
+
+    def pop(self, index=-1):
+        """
+        Remove the wheel at index from the fleet and return it. It is not shut
+        down.
+        """
+        return self.smart_wheels.pop(index)
+
+    def by_address(self, unique_address):
+        """
+        Return the wheel with unique_address, or None.
+        """
+        for smart_wheel in self.smart_wheels:
+            if smart_wheel.connection.conf.unique_address == unique_address:
+                return smart_wheel
+        return None
+
+    def connected(self):
+        """
+        Return the connected wheels.
+        """
+        return [smart_wheel for smart_wheel in self.smart_wheels if smart_wheel.is_connected()]
+
+    # fleet wide commands
+    def connect_all(self):
+        """
+        Connect all wheels that are not connected. Return the wheels that
+        could not connect.
+        """
+        failed = []
+        for smart_wheel in self.smart_wheels:
+            if smart_wheel.is_connected():
+                continue
+            try:
+                smart_wheel.connect()
+            except Exception:
+                logger.exception('Could not connect [%s]' % smart_wheel, extra=smart_wheel.extra)
+                failed.append(smart_wheel)
+        return failed
+
+    def disconnect_all(self):
+        for smart_wheel in self.connected():
+            smart_wheel.disconnect()
+
+    def enable_all(self):
+        """
+        Enable all connected wheels, return them.
+        """
+        smart_wheels = self.connected()
+        for smart_wheel in smart_wheels:
+            smart_wheel.enable()
+        return smart_wheels
+
+    def disable_all(self):
+        """
+        Disable all connected wheels, return them.
+        """
+        smart_wheels = self.connected()
+        for smart_wheel in smart_wheels:
+            smart_wheel.disable()
+        return smart_wheels
+
+    def reset_all(self):
+        smart_wheels = self.connected()
+        for smart_wheel in smart_wheels:
+            smart_wheel.reset()
+        return smart_wheels
+
+    def command_all(self, cmd, **kwargs):
+        """
+        Send cmd to all connected wheels. Return list with the results of
+        SWM.command (cmd, or CommandFuture with reply=True).
+        """
+        return [smart_wheel.command(cmd, **kwargs) for smart_wheel in self.connected()]
+
+    def set_setpoints(self, setpoints):
+        """
+        Send speed and direction setpoints to the wheels. setpoints is a list
+        of (speed, direction) in fleet order, or a dict with unique_address ->
+        (speed, direction). Wheels that are not connected are skipped.
+
+        Return the wheels that got a setpoint.
+        """
+        result = []
+        for smart_wheel, (speed, direction) in self._setpoint_pairs(setpoints):
+            smart_wheel.set_setpoint(speed, direction)
+            result.append(smart_wheel)
+        return result
+
+    def _setpoint_pairs(self, setpoints):
+        """
+        Return list of (connected smart_wheel, setpoint), see set_setpoints.
+        """
+        if isinstance(setpoints, dict):
+            pairs = [
+                (self.by_address(unique_address), setpoint)
+                for unique_address, setpoint in setpoints.items()]
+        else:
+            if len(setpoints) != len(self.smart_wheels):
+                raise ValueError('Expected %d setpoints, got %d' % (
+                    len(self.smart_wheels), len(setpoints)))
+            pairs = zip(self.smart_wheels, setpoints)
+        # in fleet order, that is the order of taking the write locks
+        order = dict((smart_wheel, idx) for idx, smart_wheel in enumerate(self.smart_wheels))
+        return sorted(
+            ((smart_wheel, setpoint) for smart_wheel, setpoint in pairs
+             if smart_wheel is not None and smart_wheel.is_connected()),
+            key=lambda pair: order[pair[0]])
+
+    def dispatch_setpoints(self, setpoints):
+        """
+        Write speed and direction setpoints to the wheels in a single burst.
+        setpoints: like set_setpoints, usually a dict with unique_address ->
+        (speed, direction).
+
+        Unlike set_setpoints, the setpoints do not go through the write queues:
+        the write locks of all wheels are taken first, then all commands are
+        written right after each other from this thread. The send time of every
+        wheel is recorded. A $0, $8 or $1 that is still in the write queue of a
+        wheel is written before its setpoint, see SWM.write_direct.
+
+        Return SetpointDispatch.
+        """
+        commands = [
+            (smart_wheel, '%s,%d,%d' % (SWM.CMD_SET_SPEED_DIRECTION, speed, direction))
+            for smart_wheel, (speed, direction) in self._setpoint_pairs(setpoints)]
+        sent = {}
+        failed = []
+        with self.dispatch_lock, ExitStack() as stack:
+            for smart_wheel, cmd in commands:
+                stack.enter_context(smart_wheel.write_lock)
+            started = time.perf_counter()
+            for smart_wheel, cmd in commands:
+                unique_address = smart_wheel.connection.conf.unique_address
+                try:
+                    sent[unique_address] = smart_wheel.write_direct(cmd)
+                except Exception:
+                    logger.exception('Dispatch of [%s] failed' % cmd, extra=smart_wheel.extra)
+                    failed.append(unique_address)
+        skew = max(sent.values()) - min(sent.values()) if sent else 0.0
+        result = SetpointDispatch(started, sent, failed, skew)
+        self.last_dispatch = result
+        if len(sent) > 1:
+            self.dispatch_skews.append(skew)
+        return result
+
+    def dispatch_stats(self):
+        """
+        Return dict with the skew (seconds between the first and the last
+        wheel) of the last DISPATCH_HISTORY dispatches to more than one wheel.
+        """
+        skews = sorted(self.dispatch_skews)
+        if not skews:
+            return {'count': 0}
+        return {
+            'count': len(skews),
+            'skew_last': self.dispatch_skews[-1],
+            'skew_mean': sum(skews) / len(skews),
+            'skew_p99': skews[min(len(skews) - 1, int(0.99 * len(skews)))],
+            'skew_max': skews[-1],
+            }
+
+    # fleet wide state
+    def telemetry(self, code):
+        """
+        Return list with the last record of code for every wheel (None if
+        there is none), in fleet order.
+        """
+        return [smart_wheel.telemetry.get(code) for smart_wheel in self.smart_wheels]
+
+    def speed_direction(self):
+        return self.telemetry(SWM.CMD_ACT_SPEED_DIRECTION)
+
+    def enabled(self):
+        """
+        Return list with the enabled state of every wheel.
+        """
+        return [smart_wheel.enabled for smart_wheel in self.smart_wheels]
+
+    def snapshots(self):
+        """
+        Return list with the current snapshot of every wheel.
+        """
+        return [smart_wheel.snapshot for smart_wheel in self.smart_wheels]
+
+    def status(self):
+        """
+        Return dict with fleet wide counters.
+        """
+        smart_wheels = list(self.smart_wheels)
+        return {
+            'wheels': len(smart_wheels),
+            'connected': sum(1 for smart_wheel in smart_wheels if smart_wheel.is_connected()),
+            'enabled': sum(1 for smart_wheel in smart_wheels if smart_wheel.enabled),
+            'total_reads': sum(smart_wheel.total_reads for smart_wheel in smart_wheels),
+            'total_writes': sum(smart_wheel.total_writes for smart_wheel in smart_wheels),
+            'missed_poll_steps': sum(smart_wheel.missed_poll_steps for smart_wheel in smart_wheels),
+            'decode_errors': sum(smart_wheel.decode_errors for smart_wheel in smart_wheels),
+            }
+
+    def shut_down(self):
+        """
+        Shut down all wheels and our IOEngine (if we started it).
+        """
+        for smart_wheel in self.smart_wheels:
+            smart_wheel.shut_down()
+        if self.own_io_engine:
+            self.io_engine.shut_down()
@@ -39,10 +39,13 @@ import connection
 import os
 
 from swm import SWM
+from fleet import SWMFleet
 from connection import NotConnectedException
 from config import config_gui
 from wheel_gui import wheel_gui
 from loghelper import setup_logging
+from metrics_http import MetricsHTTPServer
+from recorder import TelemetryRecorder
 
 logger = logging.getLogger(__name__)
 
@@ -57,8 +60,9 @@ SETTINGS_FILENAME = 'settings.json'
 
 #LOG_PATH = './logs'
 
-# SWM.incoming will get filled, the gui must pull the messages.
-POPULATE_INCOMING = True
+# SWM.incoming will get filled, the gui must pull the messages. Not needed: the
+# gui subscribes to SHOW_MESSAGES.
+POPULATE_INCOMING = False
 
 # these are the messages actually shown in the gui.
 SHOW_MESSAGES = {'$0', '$1', '$8', '$9', '$15', '$29', '$50', '$60'}
@@ -66,15 +70,16 @@ SHOW_MESSAGES = {'$0', '$1', '$8', '$9', '$15', '$29', '$50', '$60'}
 
 def smart_wheels_from_state_file(filename):
     """
-    Create and return SWM objects defined by state file.
+    Create and return SWMFleet with SWM objects defined by state file.
     """
-    smart_modules = []
     with open(GUI_STATE_FILENAME, 'r') as f:
         sm_config = json.load(f)
-    for single_config in sm_config:
-        conn = connection.Connection.from_dict(single_config['config'])
-        new_sm = SWMGuiElements(connection=conn, populate_incoming=POPULATE_INCOMING)
-        smart_modules.append(new_sm)
+    connections = [
+        connection.Connection.from_dict(single_config['config']) for single_config in sm_config]
+    smart_modules = SWMFleet()
+    for conn in connections:
+        smart_modules.create(
+            conn, swm_class=SWMGuiElements, populate_incoming=POPULATE_INCOMING)
     return smart_modules
 
 
@@ -221,7 +226,7 @@ class Interface():
     """
     Interface for SmartWheels
 
-    makes an interface for a list of SWMGuiElements objects.
+    makes an interface for a SWMFleet of SWMGuiElements objects.
     the result is a bunch of notes (tabs), each representing a SWM.
 
     self.smart_wheels must correspond to self.note.tabs().
@@ -321,8 +326,8 @@ class Interface():
         all GUI changes must be done here.
 
         - SWM status -> GUI status (with interval UPDATE_TIME_SLOW)
-        - SWM incoming messages -> display on screen with filter SHOW_MESSAGES
-        - Display messages that come from using "def message"
+        - Display messages that come from using "def message", and the 
+          SHOW_MESSAGES replies from show_reply
         - Set labels that come from using "def set_label" 
           (config change, steer command, etc)
         - Set tab names (after config change)
@@ -338,17 +343,6 @@ class Interface():
 
                 self.update_gui_from_wheel(smart_wheel)
 
-                # # empty the smart wheel incoming and show on screen if wanted
-                try_again = True
-                while try_again:
-                    try:
-                        msg = smart_wheel.incoming.pop(0)
-                        if msg[0] in SHOW_MESSAGES:
-                            self._message(smart_wheel, ','.join(msg))
-                    except IndexError:
-                        # empty
-                        try_again = False
-
                 # update all enabled / disabled buttons
                 self.update_gui_elements(smart_wheel)
                       
@@ -389,7 +383,8 @@ class Interface():
         Create a GUI for given smart wheel and put it in self.note.
 
         The smart_wheel is subscribed to the function message 
-        (means that some output will be seen in the message box)
+        (means that some output will be seen in the message box), as well as 
+        the replies in SHOW_MESSAGES.
 
         Afterwards the GUI is updated with the smart wheel state.
 
@@ -633,6 +628,7 @@ class Interface():
 
         # subscribe myself for back logging
         smart_wheel.subscribe(self.message)
+        smart_wheel.subscribe_replies(SHOW_MESSAGES, callback=self.show_reply)
         # self.update_gui_elements(smart_wheel)
 
         # TODO: how to better get tab_id?
@@ -652,7 +648,6 @@ class Interface():
         logger.info('Add new wheel')
 
         conn = connection.Connection()
-        new_sm = SWMGuiElements(connection=conn, populate_incoming=POPULATE_INCOMING)
 
         all_tabs = self.note.tabs()
         if len(all_tabs) == 0:
@@ -661,8 +656,9 @@ class Interface():
         else:
             new_pos = self.note.index(self.note.select()) + 1  # new tab is after currently selected tab
             new_pos_tk = new_pos if new_pos < len(all_tabs) else "end"
+        new_sm = self.smart_wheels.create(
+            conn, swm_class=SWMGuiElements, index=new_pos, populate_incoming=POPULATE_INCOMING)
         self.make_gui_for_smart_wheel(new_sm, position=new_pos_tk)
-        self.smart_wheels.insert(new_pos, new_sm)
 
         self.note.select(new_pos)  # select by index
 
@@ -700,10 +696,8 @@ class Interface():
         """
         logger.info('Quit')
         self.i_wanna_live = False
-        for swm in self.smart_wheels:
-            if swm.connection.is_connected():
-                swm.disconnect()
-            swm.shut_down()
+        self.smart_wheels.disconnect_all()
+        self.smart_wheels.shut_down()
         self.root.quit()
         # store my config
         state_file_from_smart_wheels(self.smart_wheels)
@@ -905,12 +899,10 @@ class Interface():
         """
         Update specific buttons for a SWM. Called from update_me.        
         """
-        cmds = smart_wheel.cmd_from_wheel
-        if SWM.CMD_ACT_SPEED_DIRECTION in cmds:
-            cmd = cmds[SWM.CMD_ACT_SPEED_DIRECTION]
-            # $13, actual wheel position, actual wheel speed, actual steer position, actual steer<CR>
-            smart_wheel.set_label(self.GUI_SPEED_ACTUAL, str(cmd[1]))
-            smart_wheel.set_label(self.GUI_STEER_ACTUAL, str(cmd[3]))
+        speed_direction = smart_wheel.telemetry.get(SWM.CMD_ACT_SPEED_DIRECTION)
+        if speed_direction is not None:
+            smart_wheel.set_label(self.GUI_SPEED_ACTUAL, str(speed_direction.wheel_pos))
+            smart_wheel.set_label(self.GUI_STEER_ACTUAL, str(speed_direction.steer_pos))
 
         smart_wheel.set_label(self.GUI_FIRMWARE, smart_wheel.firmware)
 
@@ -964,6 +956,12 @@ class Interface():
         """
         self.gui_message_queue.append((smart_wheel, msg))
 
+    def show_reply(self, smart_wheel, reply, record):
+        """
+        Reply subscription callback: show reply in the message box, thread safe.
+        """
+        self.gui_message_queue.append((smart_wheel, ','.join(reply)))
+
     def _message(self, smart_wheel, msg):
         """
         The actual message function that must be called from the main thread
@@ -1027,7 +1025,7 @@ def main():
     root = tk.Tk()
     root.title("Opteq Smart Wheel controller")
 
-    smart_modules = []
+    smart_modules = None
     smart_wheels_loaded = False
     has_argument_files = False
     load_state_failed = False
@@ -1049,12 +1047,10 @@ def main():
         if not config_filenames:  # if they didn't come from cmdline
             config_filenames = ['default_propeller.json', 'default_mock.json', 'default_ethernet.json', ]
             logger.info("Starting with default settings [%s]..." % ', '.join(config_filenames))
-        for filename in config_filenames:
-            logger.info('Reading config file [%s]...' % filename)
-            conn = connection.Connection.from_file(filename)
-            new_sm = SWMGuiElements(connection=conn, populate_incoming=POPULATE_INCOMING)
-            smart_modules.append(new_sm)
-            # If anything is wrong, it should have crashed
+        logger.info('Reading config files [%s]...' % ', '.join(config_filenames))
+        # If anything is wrong, it should have crashed
+        smart_modules = SWMFleet.from_config_files(
+            config_filenames, swm_class=SWMGuiElements, populate_incoming=POPULATE_INCOMING)
 
     # log files
     for sm in smart_modules:
@@ -1066,11 +1062,26 @@ def main():
             # logger.info("Delete existing logfile at [%s]" % filename)
             # os.remove(filename)
 
+    if settings.get('record_telemetry'):
+        for sm in smart_modules:
+            sm.start_recording(
+                settings['log_path'],
+                max_segments=settings.get('record_max_segments', TelemetryRecorder.MAX_SEGMENTS))
+
+    http_server = None
+    if settings.get('http_port') is not None:
+        http_server = MetricsHTTPServer(
+            smart_modules, host=settings.get('http_host', '127.0.0.1'),
+            port=int(settings['http_port']))
+
     interface = Interface(root, smart_modules)
 
     root.protocol("WM_DELETE_WINDOW", interface.quit)  # close window
     root.mainloop()
 
+    if http_server is not None:
+        http_server.shut_down()
+
 
 if __name__ == '__main__':
     main()  
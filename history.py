@@ -0,0 +1,192 @@
+"""
+TelemetryHistory: the recent telemetry of a SWM in NumPy ring buffers.
+
+SWM.telemetry only has the newest record per command. If a SWM is created with
+a TelemetryHistory, every decoded $13, $11 and $10 record is also appended to
+a ring buffer for that command, with a monotonic timestamp:
+
+    smart_wheel = SWM(conn, history=TelemetryHistory(max_bytes=1000000))
+    ...
+    times, values = smart_wheel.history.window('$13', 100)  # last 100 samples
+    speed = smart_wheel.history.column('$13', 'wheel_speed', 100)
+
+Windows are views on the buffer, not copies: a window of the last n samples is
+always contiguous, because every row is written twice (at i and i + capacity).
+The oldest rows of a window are overwritten when new samples come in; copy a
+window if you want to keep it.
+
+Requires numpy.
+"""
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from telemetry import COLUMN_FIELDS, column_fields, record_row, voltages_fields
+
+
+# default number of samples per command: a minute of $13 at 50 Hz
+DEFAULT_CAPACITY = 3000
+
+
+class HistoryRing(object):
+    """
+    Fixed capacity ring buffer with a float64 timestamp column and int64 value
+    columns. Append is O(1), the last n rows are a contiguous view.
+    """
+
+    def __init__(self, fields, capacity):
+        self.fields = tuple(fields)
+        self.field_index = dict((field, idx) for idx, field in enumerate(self.fields))
+        self.capacity = capacity
+        # every row is stored twice, see module docstring
+        self.times = np.zeros(2 * capacity, dtype=np.float64)
+        self.values = np.zeros((2 * capacity, len(self.fields)), dtype=np.int64)
+        # next row to write, in [0, capacity)
+        self.head = 0
+        # number of valid rows, at most capacity
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes
+
+    def append(self, timestamp, row):
+        head = self.head
+        self.times[head] = self.times[head + self.capacity] = timestamp
+        self.values[head] = self.values[head + self.capacity] = row
+        self.head = (head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def window(self, n=None):
+        """
+        Return (times, values) views of the last n rows, oldest first.
+        """
+        count = self.count
+        if n is None or n > count:
+            n = count
+        end = self.head + self.capacity
+        times = self.times[end - n:end]
+        values = self.values[end - n:end]
+        times.flags.writeable = False
+        values.flags.writeable = False
+        return times, values
+
+
+class TelemetryHistory(object):
+    """
+    Ring buffers with the telemetry history of a single SWM, one per command
+    code in telemetry.COLUMN_FIELDS.
+
+    capacity: number of samples per command.
+    max_bytes: optional memory cap for all buffers together. If capacity does
+    not fit, it is lowered (evenly for all commands).
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, max_bytes=None):
+        if np is None:
+            raise ImportError('TelemetryHistory requires numpy')
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        # command code -> HistoryRing, created with the first record
+        self.rings = {}
+        self.adc_labels = None
+        self.lock = threading.Lock()
+
+    def ring_capacity(self, num_fields):
+        """
+        Return the capacity for a ring with num_fields columns.
+        """
+        if self.max_bytes is None:
+            return self.capacity
+        # timestamp and values, every row twice
+        row_bytes = 2 * 8 * (1 + num_fields)
+        budget = self.max_bytes // len(COLUMN_FIELDS)
+        return max(1, min(self.capacity, budget // row_bytes))
+
+    def set_adc_labels(self, labels):
+        """
+        Use adc channel labels ($60) for the $10 column names.
+        """
+        self.adc_labels = tuple(labels)
+        with self.lock:
+            ring = self.rings.get('$10')
+            if ring is not None and len(ring.fields) == 3 * len(self.adc_labels):
+                ring.fields = voltages_fields(self.adc_labels)
+                ring.field_index = dict((field, idx) for idx, field in enumerate(ring.fields))
+
+    def append(self, code, record, timestamp=None):
+        """
+        Append a decoded record, from the read thread. Other codes are ignored.
+        """
+        if code not in COLUMN_FIELDS:
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+        row = record_row(code, record)
+        with self.lock:
+            ring = self.rings.get(code)
+            if ring is None or len(ring.fields) != len(row):
+                # new or the number of adc channels changed: start over
+                ring = self._new_ring(code, len(row))
+            ring.append(timestamp, row)
+
+    def _new_ring(self, code, num_fields):
+        fields = column_fields(code, num_fields, self.adc_labels)
+        ring = HistoryRing(fields, self.ring_capacity(num_fields))
+        self.rings[code] = ring
+        return ring
+
+    def fields(self, code):
+        """
+        Return column names for code, or () if there is no history.
+        """
+        ring = self.rings.get(code)
+        return ring.fields if ring is not None else ()
+
+    def window(self, code, n=None):
+        """
+        Return (times, values) read only views with the last n (default all)
+        samples of code. times has shape (n, ), values (n, number of fields).
+        """
+        with self.lock:
+            ring = self.rings.get(code)
+            if ring is None:
+                return np.zeros(0), np.zeros((0, 0), dtype=np.int64)
+            return ring.window(n)
+
+    def window_since(self, code, seconds):
+        """
+        Return (times, values) views with the samples of the last seconds.
+        """
+        times, values = self.window(code)
+        start = np.searchsorted(times, time.monotonic() - seconds)
+        return times[start:], values[start:]
+
+    def column(self, code, field, n=None):
+        """
+        Return a read only view with the last n samples of a single field.
+
+        Raise KeyError if field is unknown.
+        """
+        with self.lock:
+            ring = self.rings.get(code)
+            if ring is None:
+                raise KeyError(field)
+            idx = ring.field_index[field]
+            return ring.window(n)[1][:, idx]
+
+    def clear(self):
+        with self.lock:
+            self.rings = {}
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by all buffers.
+        """
+        return sum(ring.nbytes for ring in list(self.rings.values()))
@@ -0,0 +1,205 @@
+"""
+IOEngine: serve the I/O of many SWMs from a single thread.
+
+Normally every SWM starts its own read and write thread. With lots of wheels
+that means lots of threads, all waking up every 10 ms. An IOEngine uses
+selectors instead: the file descriptors of all serial ports and sockets are
+registered, a SWM reads when data is ready and writes when its connection is
+writable and there is something in its write queue.
+
+Connections without a file descriptor (MockSerial) are read and written on
+every tick. An exception of a single wheel is logged, it does not stop the
+engine for the other wheels.
+
+Usage:
+
+    engine = IOEngine()
+    swm = SWM(connection, io_engine=engine)
+    ...
+    swm.shut_down()
+    engine.shut_down()
+"""
+import logging
+import selectors
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def connection_fd(conn):
+    """
+    Return file descriptor of connection object, or None if it does not have one.
+    """
+    try:
+        return conn.fileno()
+    except Exception:
+        # no fileno at all (MockSerial), or a port that is not open
+        return None
+
+
+class IOEngine(object):
+    """
+    A single thread with a selector that does the reading, writing and polling
+    for all added SWMs.
+
+    Connections without a file descriptor are handled every TICK. Otherwise
+    the thread sleeps until there is I/O, a poll is due or MAX_WAIT passed.
+    """
+    TICK = 0.01
+    MAX_WAIT = 0.5
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.smart_wheels = []
+        # smart_wheel -> (connection, fd, events) as registered in selector
+        self.registered = {}
+        self.lock = threading.Lock()
+
+        # writing to the wakeup socket interrupts select, i.e. on new commands
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+
+        # used to check aliveness of the thread
+        self.loop_counter = 0
+
+        self.i_wanna_live = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.start()
+
+    def add(self, smart_wheel):
+        """
+        Start serving smart_wheel.
+        """
+        with self.lock:
+            if smart_wheel not in self.smart_wheels:
+                self.smart_wheels.append(smart_wheel)
+        self.wakeup()
+
+    def remove(self, smart_wheel):
+        """
+        Stop serving smart_wheel.
+        """
+        with self.lock:
+            if smart_wheel in self.smart_wheels:
+                self.smart_wheels.remove(smart_wheel)
+        self.wakeup()
+
+    def wakeup(self):
+        """
+        Interrupt the current select, can be called from any thread.
+        """
+        try:
+            self._wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            # already a wakeup pending, or we are shut down
+            pass
+
+    def shut_down(self):
+        """
+        Let the thread die.
+        """
+        self.i_wanna_live = False
+        self.wakeup()
+
+    def _update_registrations(self, smart_wheels):
+        """
+        Make the selector registrations match the current connections.
+
+        Return the smart wheels that have no file descriptor, they need to be
+        handled every tick.
+        """
+        no_fd = []
+        wanted = {}
+        for smart_wheel in smart_wheels:
+            conn = smart_wheel.connection.connection
+            if conn is None:
+                continue
+            fd = connection_fd(conn)
+            if fd is None or fd < 0:
+                no_fd.append(smart_wheel)
+                continue
+            events = selectors.EVENT_READ
+            if smart_wheel.write_queue:
+                events |= selectors.EVENT_WRITE
+            wanted[smart_wheel] = (conn, fd, events)
+
+        for smart_wheel, (conn, fd, events) in list(self.registered.items()):
+            if wanted.get(smart_wheel, (None, ))[0] is not conn:
+                # disconnected or reconnected. fd can already be closed, the 
+                # selector handles that
+                self.selector.unregister(fd)
+                del self.registered[smart_wheel]
+        for smart_wheel, (conn, fd, events) in wanted.items():
+            current = self.registered.get(smart_wheel)
+            if current is None:
+                self.selector.register(fd, events, smart_wheel)
+            elif current[2] != events:
+                self.selector.modify(fd, events, smart_wheel)
+            self.registered[smart_wheel] = (conn, fd, events)
+        return no_fd
+
+    def run(self):
+        """
+        The engine thread.
+        """
+        while self.i_wanna_live:
+            with self.lock:
+                smart_wheels = list(self.smart_wheels)
+            try:
+                no_fd = self._update_registrations(smart_wheels)
+            except Exception:
+                logger.exception('Could not update registrations')
+                no_fd = []
+
+            # polls are due on their own schedule. A wheel that raises is
+            # logged, the other wheels are served anyway
+            timeout = self.TICK if no_fd else self.MAX_WAIT
+            for smart_wheel in smart_wheels:
+                try:
+                    until_poll = smart_wheel.io_poll()
+                except Exception:
+                    logger.exception('Poll failed', extra=smart_wheel.extra)
+                    continue
+                if until_poll is not None:
+                    timeout = min(timeout, max(until_poll, 0))
+            for smart_wheel in no_fd:
+                try:
+                    smart_wheel.io_write()
+                    smart_wheel.io_read()
+                except Exception:
+                    logger.exception('I/O failed', extra=smart_wheel.extra)
+
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self._wakeup_recv.recv(1024):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                smart_wheel = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        smart_wheel.io_read()
+                    if mask & selectors.EVENT_WRITE:
+                        smart_wheel.io_write()
+                except Exception:
+                    logger.exception('I/O failed', extra=smart_wheel.extra)
+
+            for smart_wheel in smart_wheels:
+                try:
+                    smart_wheel.expire_replies()
+                    smart_wheel.update_state()
+                except Exception:
+                    logger.exception('Updating state failed', extra=smart_wheel.extra)
+            self.loop_counter += 1
+
+        for conn, fd, events in self.registered.values():
+            self.selector.unregister(fd)
+        self.registered = {}
+        self.selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
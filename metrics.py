@@ -0,0 +1,240 @@
+"""
+Metrics: counters, gauges and histograms of a single SWM.
+
+Every SWM has a MetricsRegistry in SWM.metrics. The read and write paths
+update the metrics, any thread can take a snapshot:
+
+    for metric in smart_wheel.metrics.snapshot():
+        print(metric.name, metric.labels, metric.value)
+
+Updating a metric is a plain attribute update without locking: every metric
+is updated from a single thread (the read thread, the write thread or the
+IOEngine). A snapshot is consistent per value, not between metrics.
+
+Metric names follow the Prometheus conventions: counters end with _total,
+times are in seconds.
+"""
+import bisect
+import threading
+import time
+
+from collections import namedtuple, OrderedDict
+
+
+# upper bounds in seconds, for round trip and queue wait times
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, float('inf'))
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+# a metric in a snapshot. labels is a tuple of (name, value), value is a
+# number, or a HistogramValue for histograms.
+MetricValue = namedtuple('MetricValue', 'name type help labels value')
+# buckets: tuple of (upper bound, cumulative count)
+HistogramValue = namedtuple('HistogramValue', 'buckets sum count')
+
+
+class Counter(object):
+    """
+    Counter that only goes up.
+    """
+    type = COUNTER
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class Meter(Counter):
+    """
+    Counter that also knows its rate per second over the last WINDOW seconds.
+    """
+    WINDOW = 10
+    __slots__ = ('seconds', 'counts', 'started')
+
+    def __init__(self):
+        super(Meter, self).__init__()
+        # count per whole second of time.monotonic(), in a ring
+        self.seconds = [0] * self.WINDOW
+        self.counts = [0] * self.WINDOW
+        self.started = int(time.monotonic())
+
+    def restart(self):
+        """
+        Start measuring the rate from now, i.e. after (re)connecting. The
+        count is kept.
+        """
+        self.seconds = [0] * self.WINDOW
+        self.counts = [0] * self.WINDOW
+        self.started = int(time.monotonic())
+
+    def inc(self, amount=1):
+        self.value += amount
+        now = int(time.monotonic())
+        idx = now % self.WINDOW
+        if self.seconds[idx] != now:
+            self.seconds[idx] = now
+            self.counts[idx] = 0
+        self.counts[idx] += amount
+
+    def rate(self):
+        """
+        Return the average per second over the last complete seconds, at most
+        WINDOW - 1 and only the ones after (re)starting. 0.0 if there is no
+        complete second yet.
+        """
+        now = int(time.monotonic())
+        # the second we started in is not complete
+        first = max(now - self.WINDOW + 1, self.started + 1)
+        if first >= now:
+            return 0.0
+        total = sum(
+            count for second, count in zip(self.seconds, self.counts)
+            if first <= second < now)
+        return total / (now - first)
+
+
+class Gauge(object):
+    """
+    Value that goes up and down. With fun, the value is fun() at snapshot time.
+    """
+    type = GAUGE
+    __slots__ = ('value', 'fun')
+
+    def __init__(self, fun=None):
+        self.value = 0
+        self.fun = fun
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.fun is not None:
+            return self.fun()
+        return self.value
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets (upper bounds, the last one must be inf).
+    """
+    type = HISTOGRAM
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        if buckets[-1] != float('inf'):
+            raise ValueError('The last bucket must be inf')
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        cumulative = []
+        total = 0
+        for bucket, count in zip(self.buckets, list(self.counts)):
+            total += count
+            cumulative.append((bucket, total))
+        return HistogramValue(tuple(cumulative), self.sum, total)
+
+    def quantile(self, q):
+        """
+        Return the upper bound of the bucket with quantile q (0-1), or None if
+        there are no observations.
+        """
+        buckets, _, count = self.get()
+        if not count:
+            return None
+        for bucket, cumulative in buckets:
+            if cumulative >= q * count:
+                return bucket
+        return buckets[-1][0]
+
+
+class MetricsRegistry(object):
+    """
+    Metrics by name and labels. Metrics are created on first use:
+
+        registry.counter('frames_total', 'Frames read').inc()
+        registry.histogram('reply_rtt_seconds', 'Round trip', code='$13').observe(0.002)
+    """
+
+    def __init__(self):
+        # (name, labels) -> (help, metric)
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, metric_class, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        entry = self.metrics.get(key)
+        if entry is None:
+            with self.lock:
+                entry = self.metrics.get(key)
+                if entry is None:
+                    entry = (help, metric_class(**kwargs))
+                    self.metrics[key] = entry
+        metric = entry[1]
+        if not isinstance(metric, metric_class):
+            raise ValueError('Metric [%s] is a %s' % (name, metric.type))
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def meter(self, name, help='', **labels):
+        return self._get(Meter, name, help, labels)
+
+    def gauge(self, name, help='', fun=None, **labels):
+        return self._get(Gauge, name, help, labels, fun=fun)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def snapshot(self):
+        """
+        Return list of MetricValue, ordered by creation.
+        """
+        result = []
+        for (name, labels), (help, metric) in list(self.metrics.items()):
+            try:
+                value = metric.get()
+            except Exception:
+                continue  # i.e. a gauge function of a connection that is gone
+            result.append(MetricValue(name, metric.type, help, labels, value))
+        return result
+
+    def as_dict(self):
+        """
+        Return snapshot as a JSON friendly dict: name -> value, or name ->
+        list of {labels, value} for metrics with labels.
+        """
+        result = OrderedDict()
+        for metric in self.snapshot():
+            value = metric.value
+            if metric.type == HISTOGRAM:
+                value = {
+                    'buckets': [['+Inf' if bucket == float('inf') else bucket, count]
+                                for bucket, count in value.buckets],
+                    'sum': value.sum,
+                    'count': value.count,
+                    }
+            if metric.labels:
+                result.setdefault(metric.name, []).append(
+                    {'labels': dict(metric.labels), 'value': value})
+            else:
+                result[metric.name] = value
+        return result
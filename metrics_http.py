@@ -0,0 +1,282 @@
+"""
+MetricsHTTPServer: serve the state and metrics of SWMs over HTTP.
+
+    GET /metrics      Prometheus text format
+    GET /state.json   JSON with the latest $13, $10, $11 and the metrics
+
+The server runs in its own thread and only reads the wheels: the immutable
+SWM.snapshot and SWM.metrics.snapshot(), no locks of the read and write
+paths are taken. A rendered response is cached until a wheel has read or
+written something, or CACHE_MAX_AGE passed.
+
+Enable it with "http_port" in settings.json for the GUI, --http-port for
+server.py, or run it headless with a SWMFleet:
+
+    $ python3 metrics_http.py --http-port 8000 default_mock.json
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import COUNTER, GAUGE, HISTOGRAM
+from swm import SWM
+
+logger = logging.getLogger(__name__)
+
+# prefix of all Prometheus metric names
+PREFIX = 'swm_'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+JSON_CONTENT_TYPE = 'application/json'
+
+# telemetry in /state.json and as gauges in /metrics
+STATE_CODES = (SWM.CMD_ACT_SPEED_DIRECTION, SWM.CMD_GET_VOLTAGES, SWM.CMD_STATUS_ERROR)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    """
+    (('wheel', 'mock'), ('code', '$13')) -> '{wheel="mock",code="$13"}'
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value)) for name, value in labels)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def wheel_state_metrics(smart_wheel, snapshot):
+    """
+    Generate (name, type, help, labels, value) of the decoded telemetry in
+    snapshot and the SWM counters.
+    """
+    yield 'enabled', GAUGE, 'Enable bit of the status word', (), int(smart_wheel.enabled)
+    yield 'replies_total', COUNTER, 'Replies read', (), smart_wheel.total_reads
+    yield 'writes_total', COUNTER, 'Commands written', (), smart_wheel.total_writes
+    for code, count in list(smart_wheel.cmd_counters.items()):
+        yield 'replies_by_code_total', COUNTER, 'Replies read per command code', (('code', code), ), count
+
+    telemetry = snapshot.telemetry
+    speed_direction = telemetry.get(SWM.CMD_ACT_SPEED_DIRECTION)
+    if speed_direction is not None:
+        for field, value in zip(speed_direction._fields, speed_direction):
+            yield field, GAUGE, 'Actual %s ($13)' % field.replace('_', ' '), (), value
+    status_error = telemetry.get(SWM.CMD_STATUS_ERROR)
+    if status_error is not None:
+        yield 'status_word', GAUGE, 'Status word ($11)', (), status_error.status
+        yield 'error_word', GAUGE, 'Error word ($11)', (), status_error.error
+    voltages = telemetry.get(SWM.CMD_GET_VOLTAGES)
+    if voltages is not None:
+        adc_map = telemetry.get(SWM.CMD_GET_ADC_LABELS)
+        labels = adc_map.labels if adc_map is not None else ()
+        for idx, (current, minimum, maximum) in enumerate(zip(*voltages)):
+            channel = labels[idx] if idx < len(labels) else str(idx)
+            channel_labels = (('channel', channel), )
+            yield 'adc', GAUGE, 'Adc value ($10)', channel_labels, current
+            yield 'adc_min', GAUGE, 'Minimum adc value ($10)', channel_labels, minimum
+            yield 'adc_max', GAUGE, 'Maximum adc value ($10)', channel_labels, maximum
+
+
+def render_prometheus(smart_wheels):
+    """
+    Return the state and metrics of smart_wheels in Prometheus text format.
+    """
+    # name -> (type, help, [(labels, value)]), samples of all wheels together
+    families = {}
+    order = []
+
+    def add(name, metric_type, help, labels, value):
+        family = families.get(name)
+        if family is None:
+            family = (metric_type, help, [])
+            families[name] = family
+            order.append(name)
+        family[2].append((labels, value))
+
+    for smart_wheel in smart_wheels:
+        wheel_labels = (('wheel', smart_wheel.extra['wheel_slug']), )
+        for name, metric_type, help, labels, value in wheel_state_metrics(
+                smart_wheel, smart_wheel.snapshot):
+            add(name, metric_type, help, wheel_labels + labels, value)
+        for metric in smart_wheel.metrics.snapshot():
+            add(metric.name, metric.type, metric.help, wheel_labels + metric.labels, metric.value)
+
+    lines = []
+    for name in order:
+        metric_type, help, samples = families[name]
+        full_name = PREFIX + name
+        lines.append('# HELP %s %s' % (full_name, help.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE %s %s' % (full_name, metric_type))
+        for labels, value in samples:
+            if metric_type == HISTOGRAM:
+                for bucket, count in value.buckets:
+                    lines.append('%s_bucket%s %d' % (
+                        full_name, format_labels(labels + (('le', format_value(bucket)), )), count))
+                lines.append('%s_sum%s %s' % (full_name, format_labels(labels), repr(value.sum)))
+                lines.append('%s_count%s %d' % (full_name, format_labels(labels), value.count))
+            else:
+                lines.append('%s%s %s' % (full_name, format_labels(labels), format_value(value)))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def render_json(smart_wheels):
+    """
+    Return the state and metrics of smart_wheels as JSON.
+    """
+    wheels = []
+    for smart_wheel in smart_wheels:
+        snapshot = smart_wheel.snapshot
+        telemetry = {}
+        for code in STATE_CODES:
+            record = snapshot.telemetry.get(code)
+            if record is not None:
+                telemetry[code] = record._asdict()
+        adc_map = snapshot.telemetry.get(SWM.CMD_GET_ADC_LABELS)
+        voltages = snapshot.telemetry.get(SWM.CMD_GET_VOLTAGES)
+        if adc_map is not None and voltages is not None:
+            telemetry['adc'] = [channel._asdict() for channel in adc_map.channels(voltages)]
+        wheels.append({
+            'name': smart_wheel.name,
+            'slug': smart_wheel.extra['wheel_slug'],
+            'unique_address': smart_wheel.connection.conf.unique_address,
+            'connected': smart_wheel.is_connected(),
+            'enabled': smart_wheel.enabled,
+            'snapshot_version': snapshot.version,
+            'telemetry': telemetry,
+            'counters': {
+                'total_reads': smart_wheel.total_reads,
+                'total_writes': smart_wheel.total_writes,
+                'decode_errors': smart_wheel.decode_errors,
+                'cmd_counters': dict(smart_wheel.cmd_counters),
+                },
+            'metrics': smart_wheel.metrics.as_dict(),
+            })
+    return json.dumps({'time': time.time(), 'wheels': wheels}, indent=2)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET only, see module docstring.
+    """
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        rendered = self.server.metrics_server.response(path)
+        if rendered is None:
+            self.send_error(404, 'Try /metrics or /state.json')
+            return
+        content_type, body = rendered
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class MetricsHTTPServer(object):
+    """
+    HTTP server in its own thread for a list of SWMs (i.e. a SWMFleet).
+
+    port 0 picks a free port, see self.port.
+    """
+    CACHE_MAX_AGE = 1.0
+    # path -> (content type, render function)
+    RENDERERS = {
+        '/metrics': (PROMETHEUS_CONTENT_TYPE, render_prometheus),
+        '/state.json': (JSON_CONTENT_TYPE, render_json),
+        }
+
+    def __init__(self, smart_wheels, host='127.0.0.1', port=8000):
+        self.smart_wheels = smart_wheels
+        # path -> (change key, monotonic time, (content type, body))
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.metrics_server = self
+        self.host, self.port = self.httpd.server_address[:2]
+        logger.info('Serving metrics on http://%s:%d/metrics' % (self.host, self.port))
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.start()
+
+    def change_key(self, smart_wheels):
+        """
+        Return something that changes when any wheel reads or writes.
+        """
+        return tuple(
+            (id(smart_wheel), smart_wheel.snapshot.version, smart_wheel.total_writes,
+             smart_wheel.is_connected())
+            for smart_wheel in smart_wheels)
+
+    def response(self, path):
+        """
+        Return (content type, body bytes) for path, or None if path is unknown.
+        """
+        renderer = self.RENDERERS.get(path)
+        if renderer is None:
+            return None
+        content_type, render = renderer
+        smart_wheels = list(self.smart_wheels)
+        key = self.change_key(smart_wheels)
+        with self.cache_lock:
+            cached = self.cache.get(path)
+            now = time.monotonic()
+            if cached is not None and cached[0] == key and now - cached[1] < self.CACHE_MAX_AGE:
+                return cached[2]
+            # render with the lock: simultaneous scrapes render only once
+            result = (content_type, render(smart_wheels).encode('UTF-8'))
+            self.cache[path] = (key, now, result)
+        return result
+
+    def shut_down(self):
+        """
+        Stop serving, wait for the thread.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+
+
+def main():
+    """
+    Headless: connect the wheels and serve their metrics until Ctrl-C.
+    """
+    from fleet import SWMFleet
+
+    parser = argparse.ArgumentParser(description='Serve SWM state and metrics over HTTP.')
+    parser.add_argument('config_filenames', nargs='+', help='connection config filenames')
+    parser.add_argument('--http-host', default='127.0.0.1')
+    parser.add_argument('--http-port', type=int, default=8000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fleet = SWMFleet.from_config_files(args.config_filenames)
+    fleet.connect_all()
+    server = MetricsHTTPServer(fleet, host=args.http_host, port=args.http_port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shut_down()
+        fleet.disconnect_all()
+        fleet.shut_down()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""
+microbench.py
+
+Microbenchmarks of the hot functions, with baselines to catch regressions.
+
+usage: microbench.py [-h] [--corpus CORPUS] [--repeat REPEAT] [--number NUMBER]
+                     [--baseline BASELINE] [--save] [--threshold THRESHOLD]
+                     [--output OUTPUT] [names ...]
+
+Benchmarks (see BENCHMARKS):
+- frame_assembly: connection.split_frames on the raw bytes of the corpus in
+  serial sized chunks, like SerialWrapper.read_frames
+- parse_frame: swm.parse_frame, the split and filter of the read path
+- get_status_error: SWM.get_status_error for the $11 replies of the corpus
+- get_adc_values: SWM.get_adc_values for every adc label
+- mock_process_incoming: MockSerial._process_incoming for the poll commands
+- config_set_vars: ConnectionConfig.set_vars for all connection types
+- log_emit: loghelper.WheelLogHandler.emit of a wheel log record
+
+The corpus is made with MockSerial answering the poll commands, or read from
+frame files recorded with the telemetry recorder (--corpus logs/mock).
+
+Every benchmark runs number times per repeat, the best repeat counts. Results
+are in ns per item (frame, reply, label, ...).
+
+With --save the results are stored in the baseline file. Otherwise the results
+are compared with the baseline file if it exists: the exit code is 1 if a
+benchmark is more than threshold times slower than its baseline.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import connection
+
+from collections import OrderedDict
+from loghelper import WheelLogHandler
+from mock_serial import MockSerial
+from replay_serial import read_frame_files, replay_filenames
+from swm import SWM, parse_frame
+
+DEFAULT_BASELINE = 'microbench_baseline.json'
+DEFAULT_THRESHOLD = 1.25
+# commands to make the mock corpus with, like the poll schedule
+CORPUS_COMMANDS = ['$13'] * 50 + ['$11'] * 10 + ['$10'] * 2 + ['$58', '$59', '$60', '$50', '$29']
+CORPUS_SIZE = 2000
+# bytes per read, like a serial read of everything that is waiting
+CHUNK_SIZE = 64
+
+
+def mock_corpus(size=CORPUS_SIZE, seed=0):
+    """
+    Return list of frames as the wheel sends them: '$13,0,0,0,0|'
+    """
+    random.seed(seed)
+    mock_serial = MockSerial()
+    try:
+        mock_serial.write('$1')
+        mock_serial.write('$2,100,200')
+        mock_serial.read_frames()
+        frames = []
+        while len(frames) < size:
+            mock_serial.write(random.choice(CORPUS_COMMANDS))
+            frames.extend(frame + SWM.SEPARATOR for frame in mock_serial.read_frames())
+    finally:
+        mock_serial.disconnect()
+    return frames[:size]
+
+
+def file_corpus(filename):
+    """
+    Return list of frames from recorded frame files (see recorder.py).
+    """
+    return [frame for timestamp, frame in read_frame_files(replay_filenames(filename))]
+
+
+def corpus_replies(frames, code):
+    return [reply for frame in frames for reply in parse_frame(frame) if reply[0] == code]
+
+
+def bench_frame_assembly(frames):
+    data = b''.join(bytes(frame + '\r\n', 'UTF-8') for frame in frames)
+    chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+    def run():
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk
+            connection.split_frames(buf)
+    return run, len(frames), None
+
+
+def bench_parse_frame(frames):
+    def run():
+        for frame in frames:
+            parse_frame(frame)
+    return run, len(frames), None
+
+
+def idle_smart_wheel():
+    """
+    Return a SWM with a mock connection that is never connected.
+    """
+    conn = connection.Connection.from_dict({
+        'connection_type': 'mock', 'name': 'microbench', 'unique_address': 1})
+    return SWM(conn, poll_status=False)
+
+
+def bench_get_status_error(frames):
+    smart_wheel = idle_smart_wheel()
+    replies = corpus_replies(frames, '$11')
+    records = []
+    for reply in replies:
+        smart_wheel.decode_reply(reply)
+        records.append(smart_wheel.telemetry['$11'])
+    telemetry = smart_wheel.telemetry
+
+    def run():
+        for record in records:
+            telemetry['$11'] = record
+            smart_wheel.get_status_error()
+    return run, len(records), smart_wheel.shut_down
+
+
+def bench_get_adc_values(frames):
+    smart_wheel = idle_smart_wheel()
+    for code in ('$60', '$10'):
+        replies = corpus_replies(frames, code)
+        if not replies:
+            raise ValueError('No %s in corpus' % code)
+        smart_wheel.cmd_from_wheel[code] = replies[-1]
+        smart_wheel.decode_reply(replies[-1])
+    labels = smart_wheel.get_adc_labels()
+
+    def run():
+        for label in labels:
+            smart_wheel.get_adc_values(label)
+    return run, len(labels), smart_wheel.shut_down
+
+
+def bench_mock_process_incoming(frames):
+    commands = [frame.split(',', 1)[0].rstrip(SWM.SEPARATOR) for frame in frames]
+    mock_serial = MockSerial()
+
+    def run():
+        for command in commands:
+            mock_serial.incoming.append(command)
+            mock_serial._process_incoming()
+        mock_serial.outgoing = []
+    return run, len(commands), mock_serial.disconnect
+
+
+def bench_config_set_vars(frames):
+    configs = [
+        {'connection_type': 'serial', 'name': 'Serial', 'comport': '/dev/ttyUSB0',
+         'baudrate': '115200', 'timeout': '1', 'unique_address': '1'},
+        {'connection_type': 'ethernet', 'name': 'Ethernet', 'ip_address': '127.0.0.1',
+         'ethernet_port': '5000', 'unique_address': '2'},
+        {'connection_type': 'mock', 'name': 'Mock', 'unique_address': '3',
+         'poll_periods': {'$13': 0.02}},
+        ]
+    conf = connection.ConnectionConfig()
+
+    def run():
+        for cfg in configs:
+            conf.set_vars(cfg)
+    return run, len(configs), None
+
+
+def bench_log_emit(frames):
+    logpath = tempfile.mkdtemp()
+    handler = WheelLogHandler(logpath, logrotate_filesize=10000000)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(levelname)s - %(filename)s:%(lineno)s - %(message)s'))
+    record = logging.LogRecord(
+        'swm', logging.DEBUG, __file__, 1, 'Command: %s', ('$13', ), None)
+    record.wheel_slug = 'microbench'
+    record.wheel_name = 'microbench'
+
+    def run():
+        handler.emit(record)
+
+    def clean_up():
+        handler.close()
+        shutil.rmtree(logpath)
+    return run, 1, clean_up
+
+
+# name -> function(frames) that returns (run, items per run, clean up or None)
+BENCHMARKS = OrderedDict([
+    ('frame_assembly', bench_frame_assembly),
+    ('parse_frame', bench_parse_frame),
+    ('get_status_error', bench_get_status_error),
+    ('get_adc_values', bench_get_adc_values),
+    ('mock_process_incoming', bench_mock_process_incoming),
+    ('config_set_vars', bench_config_set_vars),
+    ('log_emit', bench_log_emit),
+    ])
+
+
+def run_benchmark(name, frames, repeat, number):
+    """
+    Return best time per item in ns.
+    """
+    run, items, clean_up = BENCHMARKS[name](frames)
+    try:
+        best = min(timeit.Timer(run).repeat(repeat, number))
+    finally:
+        if clean_up is not None:
+            clean_up()
+    return 1e9 * best / (number * items)
+
+
+def compare(results, baseline, threshold):
+    """
+    Return list of (name, result, baseline result, ratio) of the benchmarks
+    that are more than threshold times slower than baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and result / base > threshold:
+            regressions.append((name, result, base, result / base))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SWM microbenchmarks.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, default all')
+    parser.add_argument('--corpus', help='frame file or recorder wheel directory')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=100, help='runs per repeat')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='store results as baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='slower than baseline by this factor is a regression')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark [%s], choose from %s' % (name, ', '.join(BENCHMARKS)))
+
+    frames = file_corpus(args.corpus) if args.corpus else mock_corpus()
+    results = OrderedDict()
+    for name in names:
+        results[name] = run_benchmark(name, frames, args.repeat, args.number)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    print('%-24s %12s %12s %8s' % ('benchmark', 'ns/item', 'baseline', 'ratio'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        print('%-24s %12.1f %12s %8s' % (
+            name, result, '%.1f' % base if base else '-', '%.2f' % (result / base) if base else '-'))
+
+    output = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': args.corpus or 'mock',
+        'frames': len(frames),
+        'results': results,
+        }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2)
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(output, baseline_file, indent=2)
+        print('Baseline saved in [%s]' % args.baseline)
+        return
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, result, base, ratio in regressions:
+        print('REGRESSION %s: %.1f ns, baseline %.1f ns (%.2fx)' % (name, result, base, ratio))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
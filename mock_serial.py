@@ -3,7 +3,9 @@ A mock SWM serial object, for testing.
 """
 import time
 import logging
+import os
 import random
+import select
 import threading
 import math
 from time import sleep
@@ -18,7 +20,8 @@ class MockSerial(object):
 
     - connection.py supports MockSerial
     - provide functions connect, disconnect for connection.py
-    - provide functions write, readline, get_and_erase_last_error for swm.py
+    - provide functions write, readline, read_frames, get_and_erase_last_error
+      for swm.py
       (write and readline are used in separate threads)
     - provide property last_error
 
@@ -39,6 +42,8 @@ class MockSerial(object):
 
         self.incoming = []
         self.outgoing = []
+        # notified when something is put in outgoing
+        self.outgoing_condition = threading.Condition()
 
         self.setpoint_speed = 0
         self.setpoint_dir = 0
@@ -129,6 +134,19 @@ class MockSerial(object):
         """
         return self.read()
 
+    def read_frames(self, timeout=None):
+        """
+        Return all responses in self.outgoing at once, or [] if there is nothing.
+
+        timeout: wait at most timeout seconds for a response.
+        """
+        with self.outgoing_condition:
+            if not self.outgoing and timeout:
+                self.outgoing_condition.wait(timeout)
+            result = self.outgoing
+            self.outgoing = []
+        return result
+
     def write(self, data):
         """
         Perform fake write.
@@ -161,7 +179,7 @@ class MockSerial(object):
             elif command[0] == '$2':
                 self.setpoint_speed = min(max(int(command[1]), -200), 200)
                 self.setpoint_dir = min(max(int(command[2]), -1800), 1800)
-                logging.debug("$2: speed=%d, dir=%d" % self.setpoint_speed, self.setpoint_dir)
+                logging.debug("$2: speed=%d, dir=%d" % (self.setpoint_speed, self.setpoint_dir))
                 response = ['$2']
             elif command[0] == '$8':
                 # reset
@@ -230,7 +248,9 @@ class MockSerial(object):
                     self.pid_eeprom[i] = self.pid[i]
 
             if response is not None:
-                self.outgoing.append(','.join(response))
+                with self.outgoing_condition:
+                    self.outgoing.append(','.join(response))
+                    self.outgoing_condition.notify()
             else:
                 logging.debug("warning: no response generated from command [%s]" % command_line)
 
@@ -269,3 +289,68 @@ class MockSerial(object):
         """
         logging.debug('Close mock')
         self.i_wanna_live = False
+
+
+class MockSerialPty(object):
+    """
+    A MockSerial behind a pseudo terminal (posix only).
+
+    Connect a serial connection to self.port to test the real serial code 
+    path (SerialWrapper) without hardware. Every command that comes in is
+    answered by MockSerial as a frame ending with '|' and CR LF, like the wheel
+    does.
+
+    With chunk_size, every frame is written in chunks of chunk_size bytes with
+    chunk_delay seconds in between, like a slow serial line or a USB adapter
+    that splits frames.
+    """
+    SELECT_TIMEOUT = 0.1
+    CHUNK_DELAY = 0.001
+
+    def __init__(self, chunk_size=None, chunk_delay=CHUNK_DELAY, **kwargs):
+        self.mock_serial = MockSerial(**kwargs)
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+
+        self.i_wanna_live = True
+        self._serve_thread = threading.Thread(target=self.serve_thread)
+        self._serve_thread.start()
+
+    def serve_thread(self):
+        """
+        Read commands from the pty, write MockSerial responses back.
+        """
+        current_read = b''
+        while self.i_wanna_live:
+            readable, _, _ = select.select([self.master], [], [], self.SELECT_TIMEOUT)
+            if not readable:
+                continue
+            current_read += os.read(self.master, 1024)
+            lines = current_read.replace(b'\r', b'\n').split(b'\n')
+            current_read = lines.pop()  # incomplete line
+            for line in lines:
+                if line:
+                    self.mock_serial.write(line.decode('UTF-8'))
+            for response in self.mock_serial.read_frames():
+                self.write_frame(bytes(response + '|\r\n', 'UTF-8'))
+
+    def write_frame(self, data):
+        if not self.chunk_size:
+            os.write(self.master, data)
+            return
+        for idx in range(0, len(data), self.chunk_size):
+            if idx:
+                time.sleep(self.chunk_delay)
+            os.write(self.master, data[idx:idx + self.chunk_size])
+
+    def disconnect(self):
+        """
+        Stop serving, close the pty.
+        """
+        self.i_wanna_live = False
+        self._serve_thread.join()
+        self.mock_serial.disconnect()
+        os.close(self.master)
+        os.close(self.slave)
@@ -0,0 +1,91 @@
+"""
+PollScheduler: poll every command with its own period.
+
+Fast changing data ($13 speed and position) can be polled often, while slow
+counters ($58, $59) are polled once every few seconds. Periods are in seconds
+and can be changed at any time.
+"""
+import threading
+import time
+
+from collections import defaultdict
+
+
+class PollScheduler(object):
+    """
+    Keep track of when each poll command is due.
+
+    Use due() to get the commands that must be polled now, and next_due() to
+    see how long you can wait.
+    """
+
+    def __init__(self, periods=None):
+        """
+        periods: dict with command -> period in seconds, in poll order.
+        """
+        self.lock = threading.Lock()
+        self.periods = {}
+        self.next_times = {}
+        # command -> number of missed poll steps
+        self.missed = defaultdict(int)
+        if periods:
+            for cmd, period in periods.items():
+                self.set_period(cmd, period)
+
+    def set_period(self, cmd, period):
+        """
+        Poll cmd every period seconds. A period of None or 0 stops polling cmd.
+        """
+        with self.lock:
+            if not period:
+                self.periods.pop(cmd, None)
+                self.next_times.pop(cmd, None)
+                return
+            self.periods[cmd] = float(period)
+            # a shorter period takes effect right away
+            now = time.monotonic()
+            self.next_times[cmd] = min(self.next_times.get(cmd, now), now + float(period))
+
+    def get_periods(self):
+        """
+        Return dict with command -> period in seconds.
+        """
+        with self.lock:
+            return dict(self.periods)
+
+    def due(self, now=None):
+        """
+        Return the commands that are due, in poll order, and schedule their
+        next poll.
+
+        If we are behind, a command is returned only once and the skipped steps
+        are counted in self.missed. If we are more than 10 periods behind
+        (i.e. we were disconnected), the schedule starts again.
+        """
+        if now is None:
+            now = time.monotonic()
+        result = []
+        with self.lock:
+            for cmd, period in self.periods.items():
+                next_time = self.next_times[cmd]
+                if next_time > now:
+                    continue
+                behind = now - next_time
+                if behind > 10 * period:
+                    next_time = now
+                else:
+                    missed = int(behind / period)
+                    self.missed[cmd] += missed
+                    next_time += missed * period
+                self.next_times[cmd] = next_time + period
+                result.append(cmd)
+        return result
+
+    def next_due(self):
+        """
+        Return the monotonic time of the first next poll, or None.
+        """
+        with self.lock:
+            if not self.next_times:
+                return None
+            return min(self.next_times.values())
@@ -0,0 +1,381 @@
+"""
+TelemetryRecorder: record the decoded telemetry of a SWM in columnar files.
+
+Recording is opt-in, see SWM.start_recording. Every wheel gets a directory with
+its slug as name, next to its log file from loghelper. For every command in
+telemetry.COLUMN_FIELDS ($13, $11, $10) a segment directory is created with a
+header and one append-only binary file per column:
+
+    logs/mock/13-0001/header.json  code, fields, filenames, dtypes, wheel name
+    logs/mock/13-0001/time.f8      time.time() of each sample, float64
+    logs/mock/13-0001/0.i8         int64 per field, by column index
+    ...
+
+The column files are named by index, the field names (with the adc labels of
+the wheel for $10) are only in the header.
+
+The raw frames are recorded too, as text lines with a time.time() timestamp,
+for the replay connection (see replay_serial.py):
+
+    logs/mock/frames-0001.txt      1539849600.123456 $13,0,0,0,0|
+
+Rows and frames are collected in memory and written in batches. When a segment
+gets larger than max_segment_size, the next segment (13-0002, frames-0002) is
+started. Only the newest max_segments segments per command (and frame files)
+are kept, older ones are deleted: at most about
+(len(COLUMN_FIELDS) + 1) * max_segments * max_segment_size bytes per wheel.
+
+The column files can be opened with numpy.memmap while recording continues,
+see open_segment.
+"""
+import array
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+from telemetry import COLUMN_FIELDS, column_fields, record_row
+
+logger = logging.getLogger(__name__)
+
+
+# typecodes of array.array and the matching numpy dtypes
+TIME_TYPECODE = 'd'
+VALUE_TYPECODE = 'q'
+BYTE_ORDER = '<' if sys.byteorder == 'little' else '>'
+TIME_DTYPE = BYTE_ORDER + 'f8'
+VALUE_DTYPE = BYTE_ORDER + 'i8'
+TIME_FILENAME = 'time.f8'
+VALUE_FILENAME = '%d.i8'
+HEADER_FILENAME = 'header.json'
+FRAMES = 'frames'
+FRAMES_EXTENSION = '.txt'
+
+
+def segment_name(code, seq):
+    """
+    '$13', 1 -> '13-0001'
+    """
+    return '%s-%04d' % (code.lstrip('$'), seq)
+
+
+def list_segments(wheel_path, code):
+    """
+    Return the segment directories of code in wheel_path, oldest first.
+
+    With code FRAMES, return the frame files.
+    """
+    prefix = '%s-' % code.lstrip('$')
+    if not os.path.isdir(wheel_path):
+        return []
+    return [
+        os.path.join(wheel_path, name) for name in sorted(os.listdir(wheel_path))
+        if name.startswith(prefix) and os.path.splitext(name)[0][len(prefix):].isdigit()]
+
+
+def open_segment(segment_path):
+    """
+    Return header and dict with column name -> numpy.memmap of a segment.
+    The time column is called 'time'.
+
+    Can be used while recording: all columns are cut to the number of
+    complete rows.
+    """
+    import numpy as np
+
+    with open(os.path.join(segment_path, HEADER_FILENAME)) as header_file:
+        header = json.load(header_file)
+    filenames = [('time', TIME_FILENAME, header['time_dtype'])]
+    filenames.extend(
+        (field, filename, header['value_dtype'])
+        for field, filename in zip(header['fields'], header['filenames']))
+
+    columns = {}
+    for name, filename, dtype in filenames:
+        full_filename = os.path.join(segment_path, filename)
+        if os.path.getsize(full_filename) < np.dtype(dtype).itemsize:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(full_filename, dtype=dtype, mode='r')
+    rows = min(len(column) for column in columns.values())
+    return header, dict((name, column[:rows]) for name, column in columns.items())
+
+
+class Segment(object):
+    """
+    An open segment: the column files of a single command.
+    """
+
+    def __init__(self, path, code, fields, wheel_name):
+        self.path = path
+        self.code = code
+        self.fields = tuple(fields)
+        filenames = [VALUE_FILENAME % idx for idx in range(len(self.fields))]
+        os.makedirs(path)
+        header = {
+            'code': code,
+            'fields': list(self.fields),
+            'filenames': filenames,
+            'time_dtype': TIME_DTYPE,
+            'value_dtype': VALUE_DTYPE,
+            'wheel_name': wheel_name,
+            'created': time.time(),
+            }
+        with open(os.path.join(path, HEADER_FILENAME), 'w') as header_file:
+            json.dump(header, header_file, indent=2)
+        self.time_file = open(os.path.join(path, TIME_FILENAME), 'ab')
+        self.value_files = [
+            open(os.path.join(path, filename), 'ab') for filename in filenames]
+        # batch that is not written yet
+        self.times = array.array(TIME_TYPECODE)
+        self.values = [array.array(VALUE_TYPECODE) for field in self.fields]
+        self.size = 0
+
+    def append(self, timestamp, row):
+        self.times.append(timestamp)
+        for column, value in zip(self.values, row):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.times)
+
+    def flush(self):
+        """
+        Write the batch. The time column goes last, readers use the shortest
+        column.
+        """
+        if not self.times:
+            return
+        for column, value_file in zip(self.values, self.value_files):
+            column.tofile(value_file)
+            value_file.flush()
+            self.size += len(column) * column.itemsize
+            del column[:]
+        self.times.tofile(self.time_file)
+        self.time_file.flush()
+        self.size += len(self.times) * self.times.itemsize
+        del self.times[:]
+
+    def close(self):
+        self.flush()
+        self.time_file.close()
+        for value_file in self.value_files:
+            value_file.close()
+
+
+class FrameLog(object):
+    """
+    An open frame file: a line with timestamp and frame per frame.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', encoding='UTF-8')
+        # batch that is not written yet
+        self.lines = []
+        self.size = 0
+
+    def append(self, timestamp, frame):
+        self.lines.append('%.6f %s\n' % (timestamp, frame))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def flush(self):
+        if not self.lines:
+            return
+        data = ''.join(self.lines)
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        self.lines = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class TelemetryRecorder(object):
+    """
+    Record telemetry records and frames of a single wheel in wheel_path, from
+    the read thread.
+
+    Starting a new segment (a directory, header and open files) is done on the
+    read thread, once per max_segment_size bytes of a command. Old segments
+    are deleted in a separate thread, so a large rmtree does not stall reading.
+
+    batch_size: write after this many rows of a command, or
+    flush_interval: when the oldest unwritten row is this many seconds old.
+    max_segment_size: start a new segment after this many bytes.
+    max_segments: keep this many segments per command and frame files, delete
+    the oldest. None keeps everything.
+    """
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 1.0
+    MAX_SEGMENT_SIZE = 10000000
+    MAX_SEGMENTS = 20
+
+    def __init__(
+        self, wheel_path, wheel_name='', batch_size=BATCH_SIZE,
+        flush_interval=FLUSH_INTERVAL, max_segment_size=MAX_SEGMENT_SIZE,
+        max_segments=MAX_SEGMENTS):
+        self.wheel_path = wheel_path
+        self.wheel_name = wheel_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_segment_size = max_segment_size
+        self.max_segments = max_segments
+
+        self.adc_labels = None
+        # command code -> open Segment
+        self.segments = {}
+        self.frame_log = None
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.rows = 0
+        self.closed = False
+        # threads that delete old segments and the paths they are deleting,
+        # see _remove_old_segments
+        self.remove_threads = []
+        self.removing = set()
+
+        if not os.path.exists(wheel_path):
+            os.makedirs(wheel_path)
+
+    def set_adc_labels(self, labels):
+        """
+        Use adc channel labels ($60) for the $10 column names of new segments.
+        """
+        self.adc_labels = tuple(labels)
+
+    def _remove_old_segments(self, existing):
+        """
+        Delete the oldest of the existing segments (or frame files), to keep
+        max_segments including the one that is started now. The deleting is
+        done in a thread.
+        """
+        if self.max_segments is None:
+            return
+        existing = [path for path in existing if path not in self.removing]
+        paths = existing[:max(0, len(existing) - self.max_segments + 1)]
+        if not paths:
+            return
+        self.removing.update(paths)
+        self.remove_threads = [thread for thread in self.remove_threads if thread.is_alive()]
+        thread = threading.Thread(target=self._remove_paths, args=(paths, ))
+        thread.start()
+        self.remove_threads.append(thread)
+
+    def _remove_paths(self, paths):
+        for path in paths:
+            logger.debug('Remove old telemetry segment [%s]' % path)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                logger.exception('Could not remove [%s]' % path)
+            self.removing.discard(path)
+
+    def _new_segment(self, code, fields):
+        """
+        Start the next segment of code, after the ones already on disk.
+        """
+        existing = list_segments(self.wheel_path, code)
+        seq = int(existing[-1].rsplit('-', 1)[1]) + 1 if existing else 1
+        self._remove_old_segments(existing)
+        path = os.path.join(self.wheel_path, segment_name(code, seq))
+        logger.debug('New telemetry segment [%s]' % path)
+        segment = Segment(path, code, fields, self.wheel_name)
+        self.segments[code] = segment
+        return segment
+
+    def record(self, code, record, timestamp=None):
+        """
+        Record a decoded record. Codes that are not in COLUMN_FIELDS are ignored.
+        """
+        if code not in COLUMN_FIELDS:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        row = record_row(code, record)
+        with self.lock:
+            if self.closed:
+                return
+            segment = self.segments.get(code)
+            fields = None
+            if segment is None or len(segment.fields) != len(row) or (
+                    code == '$10' and self.adc_labels is not None and
+                    segment.fields != column_fields(code, len(row), self.adc_labels)):
+                # first record, or other $10 channels: start a new segment
+                fields = column_fields(code, len(row), self.adc_labels)
+            elif segment.size >= self.max_segment_size:
+                fields = segment.fields
+            if fields is not None:
+                if segment is not None:
+                    segment.close()
+                segment = self._new_segment(code, fields)
+            segment.append(timestamp, row)
+            self.rows += 1
+            now = time.monotonic()
+            if len(segment) >= self.batch_size or now - self.last_flush > self.flush_interval:
+                self._flush()
+                self.last_flush = now
+
+    def record_frame(self, frame, timestamp=None):
+        """
+        Record a raw frame from the wheel.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if self.closed:
+                return
+            frame_log = self.frame_log
+            if frame_log is None or frame_log.size >= self.max_segment_size:
+                if frame_log is not None:
+                    frame_log.close()
+                existing = list_segments(self.wheel_path, FRAMES)
+                seq = int(os.path.splitext(existing[-1])[0].rsplit('-', 1)[1]) + 1 if existing else 1
+                self._remove_old_segments(existing)
+                frame_log = FrameLog(os.path.join(
+                    self.wheel_path, segment_name(FRAMES, seq) + FRAMES_EXTENSION))
+                self.frame_log = frame_log
+            frame_log.append(timestamp, frame)
+            now = time.monotonic()
+            if len(frame_log) >= self.batch_size or now - self.last_flush > self.flush_interval:
+                self._flush()
+                self.last_flush = now
+
+    def _flush(self):
+        for segment in self.segments.values():
+            segment.flush()
+        if self.frame_log is not None:
+            self.frame_log.flush()
+
+    def flush(self):
+        """
+        Write all batches.
+        """
+        with self.lock:
+            self._flush()
+            self.last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Write all batches and close all files.
+        """
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+            if self.frame_log is not None:
+                self.frame_log.close()
+                self.frame_log = None
+            self.closed = True
+        for thread in self.remove_threads:
+            thread.join()
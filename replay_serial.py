@@ -0,0 +1,178 @@
+"""
+Replay a recorded SWM session, for testing and benchmarking without hardware.
+
+ReplaySerial reads the frame files of the recorder (see recorder.py) and
+returns the frames through readline and read_frames, just like SerialWrapper
+does, with the original timing:
+
+- speed 1: real time
+- speed N: N times faster
+- speed 0: as fast as possible
+
+Written commands are ignored (only counted): a replay does not react.
+"""
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+
+import recorder
+
+logger = logging.getLogger(__name__)
+
+
+def replay_filenames(filename):
+    """
+    Return the frame files to replay: filename itself, or all frame files in
+    order if filename is a wheel directory of the recorder.
+    """
+    if os.path.isdir(filename):
+        return recorder.list_segments(filename, recorder.FRAMES)
+    return [filename]
+
+
+def read_frame_files(filenames):
+    """
+    Generate (timestamp, frame) from frame files.
+    """
+    for filename in filenames:
+        with open(filename, 'r', encoding='UTF-8') as frame_file:
+            for line in frame_file:
+                timestamp, _, frame = line.rstrip('\r\n').partition(' ')
+                if not frame:
+                    continue
+                try:
+                    yield float(timestamp), frame
+                except ValueError:
+                    logger.warning('Skipped line in [%s]: %s' % (filename, line))
+
+
+class ReplaySerial(object):
+    """
+    This object replays a recorded SWM session. Like MockSerial it provides
+    the functions for connection.py and swm.py: disconnect, write, readline,
+    read_frames, get_and_erase_last_error and property last_error.
+
+    filename: a frame file or a wheel directory with frame files.
+    loop: start over at the end of the recording, otherwise finished is set
+    and there are no more frames.
+    """
+    # frames per read_frames call, when replaying as fast as possible
+    MAX_FRAMES = 1000
+
+    def __init__(self, filename, speed=1.0, loop=False, timeout=1, **kwargs):
+        self.filenames = replay_filenames(filename)
+        if not self.filenames:
+            raise IOError('No frames to replay in [%s]' % filename)
+        for name in self.filenames:
+            if not os.path.exists(name):
+                raise IOError('No such file [%s]' % name)
+        self.speed = float(speed)
+        self.loop = loop
+        self.timeout = timeout
+
+        self.last_error = ''
+        self.finished = False
+        # number of frames returned and commands written
+        self.frames_replayed = 0
+        self.writes = 0
+        # frames that are due, but not returned yet by readline
+        self.due_frames = deque()
+        self.lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        """
+        Start (over) at the beginning of the recording.
+        """
+        self.frames = read_frame_files(self.filenames)
+        self.next_frame = next(self.frames, None)
+        if self.next_frame is None:
+            self.finished = True
+            return
+        self.start_recorded = self.next_frame[0]
+        self.start_time = time.monotonic()
+
+    def _due_time(self, timestamp):
+        """
+        Return time.monotonic() when the frame recorded at timestamp is due.
+        """
+        if self.speed <= 0:
+            return 0
+        return self.start_time + (timestamp - self.start_recorded) / self.speed
+
+    def _take_due(self):
+        """
+        Move the frames that are due to due_frames.
+        """
+        now = time.monotonic()
+        count = 0
+        while self.next_frame is not None and count < self.MAX_FRAMES:
+            timestamp, frame = self.next_frame
+            if self._due_time(timestamp) > now:
+                break
+            self.due_frames.append(frame)
+            count += 1
+            self.next_frame = next(self.frames, None)
+        if self.next_frame is None and not self.finished:
+            if self.loop:
+                self._start()
+            else:
+                logger.info('Replay finished after %d frames' % self.frames_replayed)
+                self.finished = True
+
+    def get_and_erase_last_error(self):
+        """
+        Return the last error occured and erase the message.
+        """
+        result = self.last_error
+        self.last_error = ''
+        return result
+
+    def read_frames(self, timeout=None):
+        """
+        Return all frames that are due, or [] if there is nothing.
+
+        timeout: wait at most timeout seconds for the next frame.
+        """
+        with self.lock:
+            self._take_due()
+            if not self.due_frames and timeout and self.next_frame is not None:
+                wait = min(self._due_time(self.next_frame[0]) - time.monotonic(), timeout)
+                if wait > 0:
+                    time.sleep(wait)
+                self._take_due()
+            result = list(self.due_frames)
+            self.due_frames.clear()
+        if not result and timeout and self.finished:
+            time.sleep(timeout)
+        self.frames_replayed += len(result)
+        return result
+
+    def readline(self):
+        """
+        Return the next frame that is due, or '' if there is nothing.
+        """
+        with self.lock:
+            if not self.due_frames:
+                self._take_due()
+            if not self.due_frames:
+                return ''
+            self.frames_replayed += 1
+            return self.due_frames.popleft()
+
+    def write(self, data):
+        """
+        Commands have no effect on a replay.
+        """
+        self.writes += 1
+
+    def disconnect(self):
+        self.frames = iter(())
+        self.next_frame = None
+        self.finished = True
+
+    def __str__(self):
+        return "[replay %s]" % ', '.join(self.filenames)
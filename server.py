@@ -4,23 +4,26 @@ console.py
 a console for smart wheel module 
 """
 import argparse
+import queue
 import signal
 import threading
 import sys
 import socket
 
 from swm import SWM
-from time import sleep
+from metrics_http import MetricsHTTPServer
+from connection import split_frames
 
 i_wanna_live = True
 
 if __name__ == '__main__':
-    global i_wanna_live
     print('smart wheel ethernet server')
     parser = argparse.ArgumentParser()
     parser.add_argument("connection_config_filename", help="local connection config")
     parser.add_argument("--host", help="default 127.0.0.1", default="127.0.0.1")
     parser.add_argument("--port", help="default 5000", default=5000)
+    parser.add_argument("--http-port", type=int, help="serve metrics over http on this port")
+    parser.add_argument("--http-host", help="default 127.0.0.1", default="127.0.0.1")
 
     args = parser.parse_args()
     
@@ -28,14 +31,23 @@ if __name__ == '__main__':
     print('Config file: %s' % config_filename)
     print('Serving on [%s:%s]' % (args.host, args.port))
 
+    # for every remote, a worker thread sends the replies of the wheel back
+    # (see subscribe_replies below)
     module = SWM.from_config(config_filename)
 
     print('connecting to wheel module...')
     module.connect()
 
+    http_server = None
+    if args.http_port is not None:
+        http_server = MetricsHTTPServer([module], host=args.http_host, port=args.http_port)
+        print('Metrics on http://%s:%s/metrics' % (args.http_host, http_server.port))
+
     def term_handler(signal, frame):
         global i_wanna_live
         print('shutting down...')
+        if http_server is not None:
+            http_server.shut_down()
         module.shut_down()
         i_wanna_live = False
         sys.exit(0)
@@ -54,28 +66,53 @@ if __name__ == '__main__':
         i += 1
         conn, addr = s.accept()
 
-        def worker():
-            global i_wanna_live
-            while i_wanna_live:
-                while module.incoming:
-                    new_message = module.incoming.pop(0)
-                    print('sending [%s]' % new_message)
-                    conn.send(bytes(new_message, 'UTF-8'))
-                sleep(0.01)
+        # all replies for this remote, the worker wakes up when one comes in
+        replies = queue.Queue(maxsize=10000)
+        subscription = module.subscribe_replies(queue=replies)
+        # set when the remote is gone
+        stop = threading.Event()
+
+        def worker(conn, replies, stop):
+            while i_wanna_live and not stop.is_set():
+                try:
+                    item = replies.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break  # remote is gone
+                smart_wheel, new_message, record = item
+                print('sending [%s]' % (new_message, ))
+                frame = ','.join(new_message) + SWM.SEPARATOR + '\r\n'
+                try:
+                    conn.send(bytes(frame, 'UTF-8'))
+                except OSError:
+                    break
         
-        t = threading.Thread(target=worker)
+        t = threading.Thread(target=worker, args=(conn, replies, stop))
         t.start()
 
         print('Connected by', addr)
+        current_read = bytearray()
         while True:
-            data = conn.recv(1024)
+            try:
+                data = conn.recv(1024)
+            except OSError:
+                break  # i.e. reset by the remote
             # print("from remote [%s]" % data)
             if not data: break
-            # conn.send(data)
-            data_decoded = data.decode('UTF-8')
-            print('From remote: %s' % data_decoded)
-            module.command(data_decoded)
+            # a single recv can hold partial or multiple commands
+            current_read += data
+            for data_decoded in split_frames(current_read):
+                print('From remote: %s' % data_decoded)
+                module.command(data_decoded)
 
             print(i, 'Data ', data)
 
+        module.unsubscribe_replies(subscription)
+        stop.set()
+        try:
+            replies.put_nowait(None)  # wake up the worker
+        except queue.Full:
+            pass  # the worker sees stop within 0.5 s, if it is still alive
+        t.join()
         conn.close()
@@ -1,17 +1,28 @@
 """
 Smart Wheel Module: SmartWheel python binding
 
-The class uses threads for read and write separately.
+The class uses threads for read and write separately, or a shared IOEngine
+(see io_engine.py) that serves many SWMs from a single thread.
 """
+import concurrent.futures
+import functools
 import json
 import threading
 import connection
 import logging
+import os
 import time
 
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from queue import Full
 from time import sleep
+from types import MappingProxyType
 from serial import Serial
+from poll_scheduler import PollScheduler
+from metrics import MetricsRegistry
+from recorder import TelemetryRecorder
+from telemetry import DECODERS
+from write_queue import WriteQueue, command_code, LANE_MOTION, LANE_TELEMETRY
 
 logger = logging.getLogger(__name__)
 
@@ -36,18 +47,158 @@ def slugify(s):
     return s.lower().replace(' ', '-')
 
 
+def parse_frame(frame, separator='|'):
+    """
+    Return all replies in a frame from the wheel; a reply is a list of strings.
+
+    '$58,0,0,6094426,0,|' -> [['$58', '0', '0', '6094426', '0']]
+    """
+    result = []
+    for item in frame.split(separator):
+        cleaned_item = item.strip()
+        if cleaned_item:
+            # split and filter out empty items
+            result.append([i for i in cleaned_item.split(',') if i != ''])
+    return result
+
+
+@functools.lru_cache(maxsize=1024)
+def status_error_bits(status, error):
+    """
+    Return read only dict with bit name -> bool for status and error words,
+    see SWM.STATUS_ERROR_BITS.
+
+    Most $11 replies repeat the previous words, so the result is cached.
+    """
+    words = (status, error)
+    return MappingProxyType(dict(
+        (name, words[word] & mask != 0) for name, word, mask in SWM.STATUS_ERROR_BITS))
+
+
+@functools.lru_cache(maxsize=1024)
+def changed_status_error_bits(status_changed, error_changed):
+    """
+    Return frozenset with the names of the bits set in status_changed and 
+    error_changed, i.e. old_status ^ new_status.
+    """
+    words = (status_changed, error_changed)
+    return frozenset(
+        name for name, word, mask in SWM.STATUS_ERROR_BITS if words[word] & mask)
+
+
+# Immutable state of a SWM, see SWM.snapshot. replies has command code -> 
+# reply tuple (like cmd_from_wheel), telemetry has command code -> record.
+WheelSnapshot = namedtuple('WheelSnapshot', ['version', 'time', 'replies', 'telemetry'])
+
+EMPTY_SNAPSHOT = WheelSnapshot(0, 0.0, MappingProxyType({}), MappingProxyType({}))
+
+
+class ReplySubscription(object):
+    """
+    A subscription to replies from the wheel, see SWM.subscribe_replies.
+
+    Matching replies are passed to callback(smart_wheel, reply, record) and/or
+    put in queue as (smart_wheel, reply, record), from the read thread. record
+    is the decoded reply (see telemetry.py) or None. If the queue is full, the
+    reply is dropped.
+
+    min_interval: deliver at most one reply per command code every 
+    min_interval seconds, the replies in between are dropped.
+    """
+    __slots__ = ('codes', 'callback', 'queue', 'min_interval', 'last_delivered', 'dropped')
+
+    def __init__(self, codes=None, callback=None, queue=None, min_interval=0):
+        self.codes = frozenset(codes) if codes is not None else None
+        self.callback = callback
+        self.queue = queue
+        self.min_interval = min_interval
+        # command code -> time.monotonic() of last delivery
+        self.last_delivered = {}
+        self.dropped = 0
+
+    def deliver(self, smart_wheel, reply, record):
+        if self.min_interval:
+            now = time.monotonic()
+            code = reply[0]
+            if now - self.last_delivered.get(code, -self.min_interval) < self.min_interval:
+                self.dropped += 1
+                return
+            self.last_delivered[code] = now
+        if self.callback is not None:
+            self.callback(smart_wheel, reply, record)
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait((smart_wheel, reply, record))
+            except Full:
+                self.dropped += 1
+
+
+class InFlightRequest(object):
+    """
+    A once command (SWM.command(cmd, once=True)) that is sent, but not 
+    answered yet.
+
+    The next attempt is allowed timeout seconds after writing, doubled for
+    every attempt up to max_backoff. Until the attempt is written, retry_at
+    is None.
+    """
+    __slots__ = ('cmd', 'attempts', 'sent', 'retry_at', 'failed')
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.attempts = 0
+        self.sent = None
+        self.retry_at = None
+        self.failed = False
+
+    def attempt(self):
+        self.attempts += 1
+        self.sent = None
+        self.retry_at = None
+
+    def written(self, now, timeout, max_backoff):
+        self.sent = now
+        self.retry_at = now + min(timeout * 2 ** (self.attempts - 1), max_backoff)
+
+
+class CommandFuture(concurrent.futures.Future):
+    """
+    Future for the reply to a command, see SWM.command(..., reply=True).
+
+    The result is the reply, i.e. ['$50', '10', '20', ...]. rtt is the time in
+    seconds from writing the command until the reply came in.
+
+    If there is no reply within timeout seconds from SWM.command, also when
+    the command is still in the write queue, concurrent.futures.TimeoutError
+    is set.
+    """
+
+    def __init__(self, cmd, timeout):
+        super(CommandFuture, self).__init__()
+        self.cmd = cmd
+        self.code = command_code(cmd)
+        self.deadline = time.perf_counter() + timeout
+        self.sent = None
+        self.rtt = None
+
+
 class SWM(object):
     """
     Smart Wheel Module: SmartWheel python binding
 
-    The class uses threads for read and write separately.
+    The class uses threads for read and write separately. If an io_engine is
+    given, no threads are started and the IOEngine calls io_read, io_write
+    and io_poll instead.
 
     You can use from_config to instantiate from a config filename.
 
-    POLL_COMMANDS are polled with interval update_period using the write thread.
+    POLL_COMMANDS are polled using the write thread, each with its own period
+    from POLL_PERIODS (default update_period). Periods can be overridden in the
+    connection config (poll_periods) or at runtime with set_poll_period.
     """
     CMD_DISABLE = '$0'
     CMD_ENABLE = '$1'
+    CMD_SET_SPEED_DIRECTION = '$2'
     CMD_RESET = '$8'
     CMD_RESET_MIN_MAX_ADC = '$9'
     CMD_GET_VOLTAGES = '$10'
@@ -80,6 +231,31 @@ class SWM(object):
     ERROR_WATCHDOG = 'error_watchdog'
     ERROR_ALARMBIT = 'error_alarmbit'
 
+    # (name, word, mask): word 0 is the status word, 1 the error word
+    STATUS_ERROR_BITS = (
+        (STATUS_ENABLEBIT, 0, 0b0000000000001000),
+        (STATUS_ESCONRDY1, 0, 0b0000000000010000),
+        (STATUS_ESCONRDY2, 0, 0b0000000000100000),
+        (STATUS_WHEELMOVE, 0, 0b0000000010000000),
+        (STATUS_STEERMOVE, 0, 0b0000000100000000),
+        (STATUS_JOYSTICKAC, 0, 0b0000001000000000),
+        (STATUS_JOYSTICKM, 0, 0b0000010000000000),
+        (STATUS_ALARMBIT, 0, 0b1000000000000000),
+        (ERROR_MAELIMPLUS, 1, 0b0000000000000001),
+        (ERROR_MAELIMMIN, 1, 0b0000000000000010),
+        (ERROR_MAECNTRERR, 1, 0b0000000000000100),
+        (ERROR_VIMALARM, 1, 0b0000000000001000),
+        (ERROR_V5ALARM, 1, 0b0000000000010000),
+        (ERROR_V3V3, 1, 0b0000000000100000),
+        (ERROR_CURRENT1, 1, 0b0000001000000000),
+        (ERROR_CURRENT2, 1, 0b0000010000000000),
+        (ERROR_COMMANDFA, 1, 0b0000100000000000),
+        (ERROR_WATCHDOG, 1, 0b0100000000000000),
+        (ERROR_ALARMBIT, 1, 0b1000000000000000),
+    )
+    # name -> (word, mask)
+    STATUS_ERROR_BIT_INDEX = dict((name, (word, mask)) for name, word, mask in STATUS_ERROR_BITS)
+
     # (command, only first time)
     POLL_COMMANDS = [
         ('$60', True),  # get adc labels
@@ -95,23 +271,67 @@ class SWM(object):
         ('$59', False),  # get counters
     ]
 
+    # poll period in seconds per command, default is update_period
+    POLL_PERIODS = {
+        '$10': 0.5,  # 2 Hz
+        '$11': 0.1,  # 10 Hz
+        '$13': 0.02,  # 50 Hz
+        '$58': 5.0,  # 0.2 Hz
+        '$59': 5.0,  # 0.2 Hz
+    }
+
     SEPARATOR = '|'    
 
+    # the read thread blocks on the connection at most this many seconds
+    READ_TIMEOUT = 0.1
+    # the read thread sleeps this long if a read returned nothing without
+    # blocking (i.e. a connection without timeout), READ_TIMEOUT after errors
+    READ_BACKOFF = 0.01
+    # default timeout in seconds for replies, see command
+    COMMAND_TIMEOUT = 1.0
+    # send times kept per command code for the reply_rtt_seconds metric
+    SENT_TIMES_MAX = 100
+    # once commands: first retry after ONCE_TIMEOUT seconds without a reply,
+    # then exponential backoff up to ONCE_MAX_BACKOFF. After ONCE_MAX_ATTEMPTS
+    # the command failed, see subscribe_once_failures
+    ONCE_TIMEOUT = 1.0
+    ONCE_MAX_BACKOFF = 30.0
+    ONCE_MAX_ATTEMPTS = 5
+
     STATE_CONNECTED = 'connected'
     STATE_NOT_CONNECTED = 'not-connected'
 
-    def __init__(self, connection, update_period=.1, populate_incoming=False, poll_status=True):
+    def __init__(
+        self, connection, update_period=.1, populate_incoming=False, poll_status=True,
+        io_engine=None, history=None):
         """
         connection object
-        update_period in seconds: poll info approximately at this rate
+        update_period in seconds: poll info approximately at this rate, if
+        there is no specific period in POLL_PERIODS or the connection config
 
         poll_status: normally you want to pull the status, except when you want
         to do it manually or it already happens (with a remote connection?)
+
+        io_engine: optional IOEngine that does all reading and writing, 
+        instead of our own read and write threads.
+
+        history: optional TelemetryHistory (see history.py) that keeps the
+        recent telemetry.
         """
 
         self.connection = connection
         self.update_period = update_period
         self.poll_status = poll_status
+        self.io_engine = io_engine
+        self.history = history
+        # TelemetryRecorder, see start_recording
+        self.recorder = None
+
+        self.poll_once = dict(self.POLL_COMMANDS)
+        poll_periods = dict(self.connection.conf.poll_periods or {})
+        self.poll_scheduler = PollScheduler(OrderedDict(
+            (poll_cmd, poll_periods.get(poll_cmd, self.POLL_PERIODS.get(poll_cmd, update_period)))
+            for poll_cmd, poll_once in self.POLL_COMMANDS))
 
         self.counter = 0
         # self.enabled = False
@@ -128,10 +348,12 @@ class SWM(object):
         # self.connected = False
 
         # add actions to the write queue and the write thread will consume them
-        self.write_queue = []  
+        self.write_queue = WriteQueue()
         self.i_wanna_live = True
 
         self.semaphore = threading.Semaphore()
+        # held while writing to the connection, see write_direct
+        self.write_lock = threading.Lock()
 
         # this connects the port
         self.serial = None
@@ -152,8 +374,36 @@ class SWM(object):
         # report subscription: who wants to know my (debug) info??
         self.report_to = []
 
+        # reply subscriptions: command code (None for all) -> tuple of 
+        # ReplySubscriptions, replaced on every change
+        self.reply_subscriptions = {}
+        self.reply_subscriptions_lock = threading.Lock()
+
         # last answers from wheel per command. key is command code, i.e. '$13'
         self.cmd_from_wheel = {}
+        # decoded records (see telemetry.py) of the last answers, same keys
+        self.telemetry = {}
+        # number of replies that could not be decoded
+        self.decode_errors = 0
+        # names of the status and error bits that changed with the last $11
+        self.status_error_changed = frozenset()
+        # immutable copy of cmd_from_wheel and telemetry, see publish_snapshot
+        self.snapshot = EMPTY_SNAPSHOT
+        self.snapshot_lock = threading.Lock()
+
+        # command code -> CommandFutures of sent commands, waiting for reply
+        self.waiting_replies = defaultdict(deque)
+        # CommandFutures of commands that are still in the write queue
+        self.queued_futures = []
+        self.waiting_replies_lock = threading.Lock()
+        # last round trip time per command code in seconds
+        self.cmd_rtt = {}
+
+        # command code -> InFlightRequest of once commands without reply yet
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        # called with (smart_wheel, cmd) when a once command failed
+        self.once_failure_callbacks = []
 
         # number of times a command is received
         self.cmd_counters = defaultdict(int)
@@ -164,108 +414,541 @@ class SWM(object):
         self.read_counter = 0
         self.write_counter = 0
 
-        self._read_thread = threading.Thread(target=self.read_thread)
-        self._read_thread.start()
-        self._write_thread = threading.Thread(target=self.write_thread)
-        self._write_thread.start()
+        # counters, gauges and histograms, see metrics.py and init_metrics
+        self.metrics = MetricsRegistry()
+        # command code -> send times of written commands, oldest first
+        self.sent_times = defaultdict(lambda: deque(maxlen=self.SENT_TIMES_MAX))
+        # command code -> reply_rtt_seconds Histogram
+        self.rtt_histograms = {}
+        self.init_metrics()
+
+        if self.io_engine is not None:
+            self.io_engine.add(self)
+        else:
+            self._read_thread = threading.Thread(target=self.read_thread)
+            self._read_thread.start()
+            self._write_thread = threading.Thread(target=self.write_thread)
+            self._write_thread.start()
         
     @classmethod
-    def from_config(cls, filename):
+    def from_config(cls, filename, **kwargs):
         """
         Use a config filename to instantiate a SWM.
+
+        kwargs are passed to the constructor.
         """
         conn = connection.Connection.from_file(filename)
-        return cls(conn)
+        return cls(conn, **kwargs)
+
+    def init_metrics(self):
+        """
+        Create the metrics that are updated by the read and write paths.
+        """
+        metrics = self.metrics
+        self.frames_meter = metrics.meter('frames_total', 'Frames read from the wheel')
+        metrics.gauge(
+            'frames_per_second', 'Frames read per second, last 10 s', fun=self.frames_meter.rate)
+        self.bytes_in_counter = metrics.counter(
+            'bytes_in_total', 'Bytes of the frames read, without line endings')
+        self.bytes_out_counter = metrics.counter(
+            'bytes_out_total', 'Bytes of the commands written, with line endings')
+        self.commands_counter = metrics.counter('commands_written_total', 'Commands written')
+        self.decode_errors_counter = metrics.counter(
+            'decode_errors_total', 'Replies that could not be decoded')
+        self.read_errors_counter = metrics.counter('read_errors_total', 'Failed reads')
+        self.write_errors_counter = metrics.counter('write_errors_total', 'Failed writes')
+        self.connects_counter = metrics.counter('connects_total', 'Connect attempts')
+        self.disconnects_counter = metrics.counter('disconnects_total', 'Disconnects')
+        metrics.gauge('connected', 'Connected (1) or not (0)', fun=lambda: int(self.is_connected()))
+        metrics.gauge('write_queue_depth', 'Commands in the write queue', fun=lambda: len(self.write_queue))
+        metrics.gauge(
+            'missed_poll_steps', 'Poll steps skipped because we were too late',
+            fun=lambda: self.missed_poll_steps)
+        self.queue_wait_histogram = metrics.histogram(
+            'write_queue_wait_seconds', 'Time from enqueue until write')
+        self.once_retries_counter = metrics.counter(
+            'once_retries_total', 'Once commands sent again after a timeout')
+        self.once_suppressed_counter = metrics.counter(
+            'once_suppressed_total', 'Once commands not sent because they are in flight')
+        self.once_failures_counter = metrics.counter(
+            'once_failures_total', 'Once commands without reply after all attempts')
+        metrics.gauge('once_in_flight', 'Once commands in flight', fun=lambda: len(self.in_flight))
+
+    def observe_rtt(self, code, now):
+        """
+        Add the time since the oldest unanswered command with code was written
+        to the reply_rtt_seconds metric. Send times older than COMMAND_TIMEOUT 
+        are dropped (no reply).
+        """
+        sent_times = self.sent_times.get(code)
+        while sent_times:
+            try:
+                rtt = now - sent_times.popleft()
+            except IndexError:
+                return  # cleared by disconnect
+            if rtt <= self.COMMAND_TIMEOUT:
+                histogram = self.rtt_histograms.get(code)
+                if histogram is None:
+                    histogram = self.metrics.histogram(
+                        'reply_rtt_seconds', 'Time from write until reply', code=code)
+                    self.rtt_histograms[code] = histogram
+                histogram.observe(rtt)
+                return
 
     def read_thread(self):
         """
         The read thread.
 
-        Read character by character to prevent losing messages and to prevent 
-        any blocking.
+        Block on the connection until data arrives (at most READ_TIMEOUT), then
+        all complete frames are read and handled at once. If the read returned
+        nothing at all without blocking, back off. A read of only part of a
+        frame is not backed off: the rest usually follows within a millisecond.
         """
         while self.i_wanna_live:
+            if self.connection.is_connected():
+                started = time.monotonic()
+                # serial and socket connections count their bytes, see connection.py
+                bytes_read = getattr(self.connection.connection, 'bytes_read', None)
+                num_frames = self.io_read(timeout=self.READ_TIMEOUT)
+                if num_frames is None:
+                    sleep(self.READ_TIMEOUT)
+                elif (not num_frames and
+                        time.monotonic() - started < self.READ_BACKOFF and
+                        getattr(self.connection.connection, 'bytes_read', None) == bytes_read):
+                    sleep(self.READ_BACKOFF)
+            else:
+                sleep(self.READ_TIMEOUT)
+            self.expire_replies()
+            self.update_state()
+
+    def io_read(self, timeout=None):
+        """
+        Read all available frames from the connection and handle them.
+
+        Called from the read thread or from the IOEngine. With timeout, wait at
+        most timeout seconds for data.
+
+        Return the number of frames, or None if reading failed.
+        """
+        num_frames = 0
+        try:
+            if self.connection.is_connected():
+                for new_read in self.connection.connection.read_frames(timeout=timeout):
+                    self.handle_read(new_read)
+                    num_frames += 1
+        except connection.ConnectionClosedException as ex:
+            self.read_errors_counter.inc()
+            self.message('Connection closed: %s' % ex)
+            self.connection.last_error = str(ex)
             try:
-                if self.connection.is_connected():
-                    # read a character at a time, until a CR is detected
-                    new_read = ''
-                    read_try = 0
-                    while not new_read and read_try < 100:
-                        new_read = self.connection.connection.readline()
-                        read_try += 1
-
-                    if new_read:
-                        # something like: $50,10,20,6000,6000,2000,10500,1|
-                        # or: $58,0,0,6094426,0,|
-                        logger.debug("Read: %s" % new_read, extra=self.extra)
-                        data_items = new_read.split(self.SEPARATOR)
-                        for item in data_items:
-                            cleaned_item = item.strip()
-                            if cleaned_item:
-                                # split and filter out empty items
-                                cleaned_item_split = [i for i in cleaned_item.split(',') if i != '']
-                                if self.populate_incoming:
-                                    self.incoming.append(cleaned_item_split)
-                                # store me
-                                self.cmd_from_wheel[cleaned_item_split[0]] = cleaned_item_split
-                                self.cmd_counters[cleaned_item_split[0]] += 1
-                                self.total_reads += 1
-                                # if cleaned_item_split[0] == '$1':
-                                #     self.enabled = True
-                                # elif cleaned_item_split[0] == '$0':
-                                #     self.enabled = False
-            except:
-                if self.connection.connection is None:
-                    continue
+                self.disconnect()
+            except AttributeError:
+                pass  # disconnected by another thread in the mean time
+            num_frames = None
+        except:
+            self.read_errors_counter.inc()
+            if self.connection.connection is not None:
                 err_msg = self.connection.connection.get_and_erase_last_error()
                 if err_msg:
                     self.message('ERROR in read thread from connection: %s' % err_msg)
-            self.update_state()
+            num_frames = None
+        self.read_counter += 1
+        return num_frames
+
+    def handle_read(self, new_read):
+        """
+        Handle a single frame from the wheel.
+
+        Split on SEPARATOR, store results in cmd_from_wheel and optionally in 
+        incoming. Telemetry replies are decoded into telemetry.
+        """
+        # something like: $50,10,20,6000,6000,2000,10500,1|
+        # or: $58,0,0,6094426,0,|
+        logger.debug("Read: %s" % new_read, extra=self.extra)
+        now = time.perf_counter()
+        self.frames_meter.inc()
+        self.bytes_in_counter.inc(len(new_read))
+        if self.recorder is not None:
+            self.recorder.record_frame(new_read)
+        replies = parse_frame(new_read, self.SEPARATOR)
+        for cleaned_item_split in replies:
+            if self.populate_incoming:
+                self.incoming.append(cleaned_item_split)
+            # store me
+            code = cleaned_item_split[0]
+            previous = self.cmd_from_wheel.get(code)
+            self.cmd_from_wheel[code] = cleaned_item_split
+            self.cmd_counters[code] += 1
+            self.total_reads += 1
+            if self.sent_times:
+                self.observe_rtt(code, now)
+            if code in self.in_flight:
+                with self.in_flight_lock:
+                    self.in_flight.pop(code, None)
+            record = self.decode_reply(cleaned_item_split, previous)
+            if record is not None:
+                if self.history is not None:
+                    self.history.append(code, record)
+                if self.recorder is not None:
+                    self.recorder.record(code, record)
+            if self.reply_subscriptions:
+                self.notify_subscriptions(cleaned_item_split, record)
+            if self.waiting_replies:
+                self.resolve_reply(cleaned_item_split)
+        if replies:
+            self.publish_snapshot(replies)
+
+    def publish_snapshot(self, replies=None):
+        """
+        Replace snapshot by a new one with the next version number. 
+
+        The dicts of the current snapshot are never changed (copy on write), 
+        so consumers can use a snapshot without locking or copying. If the 
+        version did not change, nothing changed.
+
+        replies: the new replies, or None to start over from cmd_from_wheel.
+        """
+        with self.snapshot_lock:
+            current = self.snapshot
+            if replies is None:
+                new_replies = dict(
+                    (code, tuple(reply)) for code, reply in self.cmd_from_wheel.items())
+            else:
+                new_replies = dict(current.replies)
+                for reply in replies:
+                    new_replies[reply[0]] = tuple(reply)
+            self.snapshot = WheelSnapshot(
+                current.version + 1, time.monotonic(), MappingProxyType(new_replies),
+                MappingProxyType(dict(self.telemetry)))
+
+    def notify_subscriptions(self, reply, record):
+        """
+        Deliver reply to the subscriptions for its code and for all codes.
+        """
+        subscriptions = self.reply_subscriptions
+        for subscription in subscriptions.get(reply[0], ()) + subscriptions.get(None, ()):
+            try:
+                subscription.deliver(self, reply, record)
+            except:
+                logger.exception('Reply subscription failed', extra=self.extra)
+
+    def decode_reply(self, reply, previous=None):
+        """
+        Decode reply into telemetry (see telemetry.py), return the record or
+        None if reply is not telemetry or could not be decoded.
+
+        If reply is the same as previous, the current record is kept.
+        """
+        code = reply[0]
+        decoder = DECODERS.get(code)
+        if decoder is None:
+            return None
+        if reply == previous and code in self.telemetry:
+            if code == self.CMD_STATUS_ERROR:
+                self.status_error_changed = frozenset()
+            return self.telemetry[code]
+        try:
+            record = decoder(reply)
+        except (ValueError, IndexError):
+            self.decode_errors += 1
+            self.decode_errors_counter.inc()
+            logger.warning("Could not decode: %s" % ','.join(reply), extra=self.extra)
+            return None
+        if code == self.CMD_STATUS_ERROR:
+            self._update_status_error_changed(record)
+        elif code == self.CMD_GET_ADC_LABELS:
+            if self.history is not None:
+                self.history.set_adc_labels(record.labels)
+            if self.recorder is not None:
+                self.recorder.set_adc_labels(record.labels)
+        self.telemetry[code] = record
+        return record
+
+    def resolve_reply(self, reply):
+        """
+        Set reply as result of the oldest CommandFuture waiting for it.
+        """
+        code = reply[0]
+        with self.waiting_replies_lock:
+            futures = self.waiting_replies.get(code)
+            future = None
+            while futures:
+                future = futures.popleft()
+                if not future.done():
+                    break
+                future = None
+            if not futures:
+                self.waiting_replies.pop(code, None)
+        if future is None:
+            return
+        future.rtt = time.perf_counter() - future.sent
+        self.cmd_rtt[code] = future.rtt
+        try:
+            future.set_result(reply)
+        except concurrent.futures.InvalidStateError:
+            pass  # cancelled in the mean time
+
+    def expire_replies(self, exception=None):
+        """
+        Fail CommandFutures that are past their deadline with a TimeoutError,
+        sent or still in the write queue.
 
-            sleep(0.01)  # 10 ms sleep
-            self.read_counter += 1
+        If exception is given, fail all waiting CommandFutures with exception.
+        """
+        now = time.perf_counter()
+        failed = []
+        with self.waiting_replies_lock:
+            if self.queued_futures:
+                queued_futures = []
+                for future in self.queued_futures:
+                    if future.sent is not None or future.done():
+                        continue  # written, now in waiting_replies
+                    if exception is not None or future.deadline < now:
+                        failed.append(future)
+                    else:
+                        queued_futures.append(future)
+                self.queued_futures = queued_futures
+            for code, futures in list(self.waiting_replies.items()):
+                while futures and (
+                        exception is not None or futures[0].done() or 
+                        futures[0].deadline < now):
+                    failed.append(futures.popleft())
+                if not futures:
+                    del self.waiting_replies[code]
+        for future in failed:
+            future_exception = exception
+            if future_exception is None:
+                future_exception = concurrent.futures.TimeoutError(
+                    'no reply to [%s] in time' % future.cmd)
+            try:
+                future.set_exception(future_exception)
+            except concurrent.futures.InvalidStateError:
+                pass  # already done or cancelled
+        if self.in_flight:
+            self.expire_in_flight()
+
+    def expire_in_flight(self):
+        """
+        Mark once commands as failed after ONCE_MAX_ATTEMPTS without reply and
+        call the once_failure_callbacks. They are not sent again until the
+        next connect.
+        """
+        now = time.monotonic()
+        failed = []
+        with self.in_flight_lock:
+            for request in self.in_flight.values():
+                if (not request.failed and request.attempts >= self.ONCE_MAX_ATTEMPTS and
+                        request.retry_at is not None and now >= request.retry_at):
+                    request.failed = True
+                    failed.append(request)
+        for request in failed:
+            self.once_failures_counter.inc()
+            self.message('No reply to [%s] after %d attempts' % (request.cmd, request.attempts))
+            for callback in self.once_failure_callbacks:
+                try:
+                    callback(self, request.cmd)
+                except:
+                    logger.exception('Once failure callback failed', extra=self.extra)
+
+    def send_once(self, cmd):
+        """
+        Return True if once command cmd must be sent now: it was never sent, or
+        the last attempt timed out. Register the attempt.
+
+        The timeout starts when the attempt is written (see once_written): an
+        attempt that is still in the write queue is not sent again.
+        """
+        now = time.monotonic()
+        code = command_code(cmd)
+        with self.in_flight_lock:
+            request = self.in_flight.get(code)
+            if request is None:
+                request = InFlightRequest(cmd)
+                self.in_flight[code] = request
+            else:
+                if request.retry_at is None:
+                    waiting = self.write_queue.queued(code)
+                else:
+                    waiting = now < request.retry_at
+                if request.failed or waiting or request.attempts >= self.ONCE_MAX_ATTEMPTS:
+                    self.once_suppressed_counter.inc()
+                    return False
+                self.once_retries_counter.inc()
+            request.attempt()
+        return True
+
+    def once_written(self, code):
+        """
+        Start the timeout of the once command with code, if it is in flight
+        and was not written yet. Called after writing.
+        """
+        with self.in_flight_lock:
+            request = self.in_flight.get(code)
+            if request is not None and request.retry_at is None:
+                request.written(time.monotonic(), self.ONCE_TIMEOUT, self.ONCE_MAX_BACKOFF)
+
+    def clear_in_flight(self):
+        """
+        Forget all once commands in flight, i.e. after (re)connecting.
+        """
+        with self.in_flight_lock:
+            self.in_flight = {}
 
     def write_thread(self):
         """
         The write thread.
 
         Write the self.write_queue to a connection, with redundancy.
+
+        In between, wait until a command is put in the write queue or the next
+        poll is due.
         """
-        next_poll = time.time()
         while self.i_wanna_live:
-            try:
-                if self.connection.is_connected():
-                    while self.write_queue:  # thread safe?
-                        write_item = self.write_queue.pop(0)
-                        # logger.debug("going to write '%s'" % write_item)
-                        self.connection.connection.write(write_item)
-                        self.total_writes += 1
-            except:
-                if self.connection.connection is None:
-                    continue
+            self.io_write()
+            until_poll = self.io_poll()
+
+            if self.connection.is_connected():
+                if until_poll is None:
+                    until_poll = self.update_period
+                self.write_queue.wait(max(until_poll, 0))
+            else:
+                sleep(self.update_period)
+
+    def io_write(self):
+        """
+        Write everything in the write_queue to the connection.
+
+        Called from the write thread or from the IOEngine.
+        """
+        try:
+            if self.connection.is_connected():
+                write_item = self.write_queue.get()
+                while write_item is not None:
+                    # logger.debug("going to write '%s'" % write_item)
+                    with self.write_lock:
+                        self._write_item(write_item)
+                    write_item = self.write_queue.get()
+        except:
+            self.write_errors_counter.inc()
+            if self.connection.connection is not None:
                 err_msg = self.connection.connection.get_and_erase_last_error()
                 if err_msg:
                     self.message('ERROR in write thread from connection: %s' % err_msg)
-            
-            # update variables poll
-            if self.poll_status and self.connection.is_connected():
-                curr_time = time.time()
-                do_poll = False
-                if (curr_time - next_poll) > 10 * self.update_period:
-                    next_poll = curr_time - self.update_period  # artificially set a new next_poll
-                while next_poll < curr_time:
-                    if do_poll:
-                        # missed some update step
-                        logger.info("missed update step: %s" % next_poll, extra=self.extra)
-                    next_poll += self.update_period
-                    do_poll = True
-                if do_poll:  # in case we missed some update step, just do update once.
-                    logger.debug('update poll', extra=self.extra)
-                    for poll_cmd, poll_once in self.POLL_COMMANDS:
-                        self.command(poll_cmd, once=poll_once)
-
-            sleep(0.01)  # 10 ms sleep
-            self.write_counter += 1
+        self.write_counter += 1
+
+    def io_poll(self):
+        """
+        Put the POLL_COMMANDS that are due in the write queue.
+
+        Return the number of seconds until the next poll is due, or None if we 
+        are not polling at all.
+        """
+        if not (self.poll_status and self.connection.is_connected()):
+            return None
+        due = self.poll_scheduler.due()
+        if due:
+            logger.debug('update poll %s' % ', '.join(due), extra=self.extra)
+            for poll_cmd in due:
+                try:
+                    self.command(
+                        poll_cmd, once=self.poll_once.get(poll_cmd, False), lane=LANE_TELEMETRY)
+                except connection.NotConnectedException:
+                    # disconnected by another thread in the mean time
+                    return None
+        next_due = self.poll_scheduler.next_due()
+        if next_due is None:
+            return None
+        return next_due - time.monotonic()
+
+    def _write_item(self, write_item):
+        """
+        Write a WriteItem from the write queue, with write_lock held.
+        """
+        if write_item.future is not None:
+            write_item.future.sent = time.perf_counter()
+            with self.waiting_replies_lock:
+                self.waiting_replies[write_item.code].append(write_item.future)
+        self.connection.connection.write(write_item.cmd)
+        self._count_write(write_item.cmd, write_item.code, write_item.enqueued)
+
+    def write_direct(self, cmd):
+        """
+        Write cmd to the connection now, bypassing the write queue. An unsent
+        command with the same code (i.e. an older setpoint) is removed from the
+        queue. The caller must hold write_lock, see SWMFleet.dispatch_setpoints.
+
+        The safety and motion lanes of the queue are written first: a setpoint
+        never overtakes a $0, $8 or $1 that was put before it.
+
+        Return time.perf_counter() right after writing.
+        """
+        code = command_code(cmd)
+        self.write_queue.discard(code)
+        write_item = self.write_queue.get(LANE_MOTION)
+        while write_item is not None:
+            self._write_item(write_item)
+            write_item = self.write_queue.get(LANE_MOTION)
+        self.connection.connection.write(cmd)
+        return self._count_write(cmd, code)
+
+    def _count_write(self, cmd, code, enqueued=None):
+        """
+        Update counters and metrics after writing cmd, with write_lock held.
+
+        Return time.perf_counter().
+        """
+        now = time.perf_counter()
+        self.total_writes += 1
+        self.commands_counter.inc()
+        self.bytes_out_counter.inc(len(cmd) + 2)  # CR LF
+        self.sent_times[code].append(now)
+        if enqueued is not None:
+            self.queue_wait_histogram.observe(now - enqueued)
+        if code in self.in_flight:
+            self.once_written(code)
+        return now
+
+    def set_poll_period(self, cmd, period):
+        """
+        Poll cmd every period seconds from now on. None or 0 stops polling cmd.
+        """
+        self.poll_scheduler.set_period(cmd, period)
+        if self.io_engine is not None:
+            self.io_engine.wakeup()
+        else:
+            self.write_queue.wakeup()
+
+    def start_recording(self, log_path, **kwargs):
+        """
+        Record decoded telemetry and frames in log_path/<wheel slug>, see 
+        recorder.py.
+
+        kwargs are passed to TelemetryRecorder.
+        """
+        self.stop_recording()
+        recorder = TelemetryRecorder(
+            os.path.join(log_path, self.extra['wheel_slug']), wheel_name=self.name, **kwargs)
+        adc_map = self.telemetry.get(self.CMD_GET_ADC_LABELS)
+        if adc_map is not None:
+            recorder.set_adc_labels(adc_map.labels)
+        self.recorder = recorder
+        self.message("recording telemetry in [%s]" % recorder.wheel_path)
+
+    def stop_recording(self):
+        """
+        Stop recording, write everything that is not written yet.
+        """
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is not None:
+            recorder.close()
+
+    @property
+    def missed_poll_steps(self):
+        """
+        Total number of poll steps that were skipped because we were too late.
+        """
+        return sum(self.poll_scheduler.missed.values())
 
     def subscribe(self, callback_fun):
         """
@@ -273,6 +956,40 @@ class SWM(object):
         """
         self.report_to.append(callback_fun)
 
+    def subscribe_once_failures(self, callback_fun):
+        """
+        Subscribe function for once commands without reply after 
+        ONCE_MAX_ATTEMPTS. Will be called with (smart_wheel instance, cmd).
+        """
+        self.once_failure_callbacks.append(callback_fun)
+
+    def subscribe_replies(self, codes=None, callback=None, queue=None, min_interval=0):
+        """
+        Subscribe to replies with command codes in codes (i.e. ['$13', '$11']),
+        or all replies if codes is None. See ReplySubscription.
+
+        Return the ReplySubscription, to be used in unsubscribe_replies.
+        """
+        subscription = ReplySubscription(codes, callback, queue, min_interval)
+        with self.reply_subscriptions_lock:
+            subscriptions = dict(self.reply_subscriptions)
+            for code in (subscription.codes if subscription.codes is not None else [None]):
+                subscriptions[code] = subscriptions.get(code, ()) + (subscription, )
+            self.reply_subscriptions = subscriptions
+        return subscription
+
+    def unsubscribe_replies(self, subscription):
+        """
+        Stop delivering replies to subscription.
+        """
+        with self.reply_subscriptions_lock:
+            subscriptions = {}
+            for code, code_subscriptions in self.reply_subscriptions.items():
+                code_subscriptions = tuple(s for s in code_subscriptions if s is not subscription)
+                if code_subscriptions:
+                    subscriptions[code] = code_subscriptions
+            self.reply_subscriptions = subscriptions
+
     def connect(self):
         """
         Connect the connection object
@@ -280,14 +997,38 @@ class SWM(object):
         self.message("connect")
         logger.info("going to connect to connection!!", extra=self.extra)
         logger.debug(str(self.connection), extra=self.extra)
-        return self.connection.connect()  # will create connection.connection
+        # the config may have been changed since we started
+        for poll_cmd, period in (self.connection.conf.poll_periods or {}).items():
+            self.poll_scheduler.set_period(poll_cmd, period)
+        result = self.connection.connect()  # will create connection.connection
+        self.connects_counter.inc()
+        self.frames_meter.restart()
+        self.clear_in_flight()
+        if self.io_engine is not None:
+            self.io_engine.wakeup()  # register the new connection
+        return result
 
     def disconnect(self):
         """
         Disconnect the connection object, clear memory.
         """
         self.cmd_from_wheel = {}  # reset all we've got from the wheel
-        return self.connection.disconnect()
+        self.telemetry = {}
+        self.status_error_changed = frozenset()
+        self.sent_times.clear()
+        self.clear_in_flight()
+        self.disconnects_counter.inc()
+        self.publish_snapshot()
+        # nothing of before the disconnect is written after a reconnect
+        self.write_queue.clear()
+        self.expire_replies(
+            exception=connection.NotConnectedException('disconnected'))
+        result = self.connection.disconnect()
+        if self.io_engine is not None:
+            self.io_engine.wakeup()
+        if self.recorder is not None:
+            self.recorder.flush()
+        return result
 
     def is_connected(self):
         """
@@ -308,7 +1049,7 @@ class SWM(object):
         Reset command
         """
         self.message("reset")
-        self.write_queue.append(self.CMD_RESET)
+        self.enqueue(self.CMD_RESET)
         return self.CMD_RESET
 
     @connected_fun
@@ -316,7 +1057,7 @@ class SWM(object):
         """
         Enable command
         """
-        self.write_queue.append(self.CMD_ENABLE)
+        self.enqueue(self.CMD_ENABLE)
         self.message("enable")
         return self.CMD_ENABLE
 
@@ -325,24 +1066,65 @@ class SWM(object):
         """
         Disable command
         """
-        self.write_queue.append(self.CMD_DISABLE)
+        self.enqueue(self.CMD_DISABLE)
         self.message("disable")
         return self.CMD_DISABLE
 
     @connected_fun
-    def command(self, cmd, once=False):
+    def set_setpoint(self, speed, direction):
+        """
+        Set speed and direction setpoint
+        """
+        cmd = '%s,%d,%d' % (self.CMD_SET_SPEED_DIRECTION, speed, direction)
+        self.enqueue(cmd)
+        return cmd
+
+    @connected_fun
+    def command(self, cmd, once=False, reply=False, timeout=None, lane=None):
         """
         Send command to write_queue
 
-        'once' if we need only 1 reply with this command
+        'once' if we need only 1 reply with this command. Until the reply
+        comes in, the command is in flight: it is only sent again after a
+        timeout with exponential backoff (ONCE_TIMEOUT, ONCE_MAX_BACKOFF) and
+        at most ONCE_MAX_ATTEMPTS times, see send_once.
+
+        Returns cmd, or if reply is True a CommandFuture that gets the reply 
+        to cmd within timeout seconds (default COMMAND_TIMEOUT).
+
+        lane: write queue priority lane (see write_queue.py), by default it 
+        depends on the command code.
         """
         self.message("Command: %s" % cmd, logging_only=True)
+        future = None
+        if reply:
+            future = CommandFuture(
+                cmd, self.COMMAND_TIMEOUT if timeout is None else timeout)
         if once:
             if cmd not in self.cmd_from_wheel.keys():
-                self.write_queue.append(cmd)
+                if self.send_once(cmd):
+                    self.enqueue(cmd, future, lane)
+                elif future is not None:
+                    # in flight: wait for the reply to the earlier attempt
+                    future.sent = time.perf_counter()
+                    with self.waiting_replies_lock:
+                        self.waiting_replies[future.code].append(future)
+            elif future is not None:
+                future.set_result(self.cmd_from_wheel[cmd])
         else:
-            self.write_queue.append(cmd)
-        return cmd
+            self.enqueue(cmd, future, lane)
+        return cmd if future is None else future
+
+    def enqueue(self, cmd, future=None, lane=None):
+        """
+        Add cmd to the write queue, wake up the IOEngine if we have one.
+        """
+        if future is not None:
+            with self.waiting_replies_lock:
+                self.queued_futures.append(future)
+        self.write_queue.put(cmd, future, lane)
+        if self.io_engine is not None:
+            self.io_engine.wakeup()
 
     def __str__(self):
         return '{wheel_name} [{wheel_slug}]'.format(**self.extra)
@@ -353,6 +1135,10 @@ class SWM(object):
         """
         self.message("shut down issued")
         self.i_wanna_live = False
+        self.write_queue.wakeup()
+        if self.io_engine is not None:
+            self.io_engine.remove(self)
+        self.stop_recording()
 
     def message(self, msg, logging_only=False):
         """
@@ -406,47 +1192,40 @@ class SWM(object):
 
     @property
     def enabled(self):
-        return self.get_status_error()[self.STATUS_ENABLEBIT]
+        return self.status_bit(self.STATUS_ENABLEBIT)
 
     def _get_status_error(self):
         """
         Return status and error words, if available
         """
         result = 0, 0
-        if self.CMD_STATUS_ERROR in self.cmd_from_wheel:
-            cmd = self.cmd_from_wheel[self.CMD_STATUS_ERROR]
-            status = int(cmd[1])
-            error = int(cmd[2])
-            result = status, error
+        status_error = self.telemetry.get(self.CMD_STATUS_ERROR)
+        if status_error is not None:
+            result = status_error.status, status_error.error
         return result
 
     def get_status_error(self):
         """
-        Return status and errors in dict.
+        Return status and errors in (read only) dict.
+        """
+        return status_error_bits(*self._get_status_error())
+
+    def status_bit(self, name):
+        """
+        Return a single status or error bit, i.e. status_bit(SWM.STATUS_ENABLEBIT).
+
+        Raise KeyError if name is unknown.
+        """
+        word, mask = self.STATUS_ERROR_BIT_INDEX[name]
+        return self._get_status_error()[word] & mask != 0
+
+    def _update_status_error_changed(self, new_status_error):
+        """
+        Set status_error_changed using the new and the current $11 record.
         """
         status, error = self._get_status_error()
-        result = {
-            self.STATUS_ENABLEBIT: bool(0b0000000000001000 & status > 0),
-            self.STATUS_ESCONRDY1: bool(0b0000000000010000 & status > 0),
-            self.STATUS_ESCONRDY2: bool(0b0000000000100000 & status > 0),
-            self.STATUS_WHEELMOVE: bool(0b0000000010000000 & status > 0),
-            self.STATUS_STEERMOVE: bool(0b0000000100000000 & status > 0),
-            self.STATUS_JOYSTICKAC: bool(0b0000001000000000 & status > 0),
-            self.STATUS_JOYSTICKM: bool(0b0000010000000000 & status > 0),
-            self.STATUS_ALARMBIT: bool(0b1000000000000000 & status > 0),
-            self.ERROR_MAELIMPLUS: bool(0b0000000000000001 & error > 0),
-            self.ERROR_MAELIMMIN: bool(0b0000000000000010 & error > 0),
-            self.ERROR_MAECNTRERR: bool(0b0000000000000100 & error > 0),
-            self.ERROR_VIMALARM: bool(0b0000000000001000 & error > 0),
-            self.ERROR_V5ALARM: bool(0b0000000000010000 & error > 0),
-            self.ERROR_V3V3: bool(0b0000000000100000 & error > 0),
-            self.ERROR_CURRENT1: bool(0b0000001000000000 & error > 0),
-            self.ERROR_CURRENT2: bool(0b0000010000000000 & error > 0),
-            self.ERROR_COMMANDFA: bool(0b0000100000000000 & error > 0),
-            self.ERROR_WATCHDOG: bool(0b0100000000000000 & error > 0),
-            self.ERROR_ALARMBIT: bool(0b1000000000000000 & error > 0),
-            }
-        return result
+        self.status_error_changed = changed_status_error_bits(
+            status ^ new_status_error.status, error ^ new_status_error.error)
 
     def get_adc_labels(self):
         """
@@ -455,13 +1234,10 @@ class SWM(object):
         CMD_GET_ADC_LABELS returns 
         "'$60', '8', 'Vin', '3V3', 'NC', 'Curr1', 'Curr2', 'Nc2', 'Nc3', 'NTC'"
         """
-        result = []
-        if self.CMD_GET_ADC_LABELS in self.cmd_from_wheel:
-            num_labels = int(self.cmd_from_wheel[self.CMD_GET_ADC_LABELS][1])
-            for i in range(num_labels):
-                label = self.cmd_from_wheel[self.CMD_GET_ADC_LABELS][i+2]
-                result.append(label)
-        return result
+        adc_map = self.telemetry.get(self.CMD_GET_ADC_LABELS)
+        if adc_map is None:
+            return []
+        return list(adc_map.labels)
 
     def get_adc_values(self, name):
         """
@@ -469,20 +1245,26 @@ class SWM(object):
 
         Raise ValueError if name is unknown
 
-        name is made case insensitive.
+        name is made case insensitive, it can also be a channel index.
 
         you must have already have results of the commands 
         CMD_GET_ADC_LABELS and CMD_GET_VOLTAGES or you will get Nones
         """
         result = None, None, None
-        if (self.CMD_GET_ADC_LABELS in self.cmd_from_wheel and 
-            self.CMD_GET_VOLTAGES in self.cmd_from_wheel):
-
-            labels = self.get_adc_labels()
-            lower_labels = [l.lower() for l in labels]
-            num_labels = len(labels)
-            var_idx = lower_labels.index(name.lower())  # valueerror if not in list
+        adc_map = self.telemetry.get(self.CMD_GET_ADC_LABELS)
+        voltages = self.telemetry.get(self.CMD_GET_VOLTAGES)
+        if adc_map is not None and voltages is not None:
+            result = adc_map.values(voltages, name)  # valueerror if unknown
+        return result
 
-            adc = self.cmd_from_wheel[SWM.CMD_GET_VOLTAGES]
-            result = int(adc[var_idx+1]), int(adc[var_idx+num_labels+1]), int(adc[var_idx+num_labels*2+1])
-        return result
\ No newline at end of file
+    def get_adc_channels(self):
+        """
+        Return all adc channels in a list of AdcChannel (label, current, 
+        minimum, maximum), or [] if there are no results of CMD_GET_ADC_LABELS
+        and CMD_GET_VOLTAGES yet.
+        """
+        adc_map = self.telemetry.get(self.CMD_GET_ADC_LABELS)
+        voltages = self.telemetry.get(self.CMD_GET_VOLTAGES)
+        if adc_map is None or voltages is None:
+            return []
+        return adc_map.channels(voltages)
\ No newline at end of file
@@ -0,0 +1,217 @@
+"""
+Typed records for the telemetry replies of a SWM.
+
+Replies come in as lists of strings. The replies in DECODERS are decoded once
+when they arrive (see SWM.handle_read) and stored in SWM.telemetry, so the GUI
+and servers can use the integer fields without parsing again:
+
+    decode(['$13', '10', '20', '-30', '0'])
+    -> SpeedDirection(wheel_pos=10, wheel_speed=20, steer_pos=-30, steer_speed=0)
+
+The records are namedtuples: immutable, no __dict__ and they can still be
+indexed like the original reply (without the command code). The $60 adc 
+labels become an AdcChannelMap.
+"""
+from collections import namedtuple
+
+
+# $10: tuples with the current, minimum and maximum value per adc channel. The
+# channel labels are in the $60 reply.
+Voltages = namedtuple('Voltages', ['current', 'minimum', 'maximum'])
+
+# $11: status and error words, see SWM.get_status_error for the bits
+StatusError = namedtuple('StatusError', ['status', 'error'])
+
+# $13: actual wheel position, wheel speed, steer position, steer speed
+SpeedDirection = namedtuple(
+    'SpeedDirection', ['wheel_pos', 'wheel_speed', 'steer_pos', 'steer_speed'])
+
+# $50: PID parameters, in the order of $51 parameter index
+PIDParameters = namedtuple('PIDParameters', [
+    'kpid_wheel', 'kpid_steer', 'ilim_wheel', 'ilim_steer', 'mae_offset',
+    'vin_min', 'module_address'])
+
+# a single adc channel, see AdcChannelMap.channels
+AdcChannel = namedtuple('AdcChannel', ['label', 'current', 'minimum', 'maximum'])
+
+# $58: process times, $59: counters. The number of values depends on the
+# firmware.
+ProcessTimes = namedtuple('ProcessTimes', ['times'])
+Counters = namedtuple('Counters', ['counters'])
+
+
+class AdcChannelMap(object):
+    """
+    The adc channels from a $60 reply, to look up $10 (Voltages) values by 
+    label or index.
+
+    $60 returns "'$60', '8', 'Vin', '3V3', 'NC', 'Curr1', 'Curr2', 'Nc2', 'Nc3', 'NTC'"
+    """
+    __slots__ = ('labels', 'index')
+
+    def __init__(self, labels):
+        self.labels = tuple(labels)
+        # lower case label -> channel index, the first one wins
+        self.index = {}
+        for idx, label in enumerate(self.labels):
+            self.index.setdefault(label.lower(), idx)
+
+    def channel_index(self, key):
+        """
+        Return channel index of key: a label (case insensitive) or an index.
+
+        Raise ValueError if key is unknown.
+        """
+        if isinstance(key, int):
+            if not 0 <= key < len(self.labels):
+                raise ValueError('adc channel %d does not exist' % key)
+            return key
+        try:
+            return self.index[key.lower()]
+        except KeyError:
+            raise ValueError('adc channel %s does not exist' % key)
+
+    def values(self, voltages, key):
+        """
+        Return current, minimum, maximum of channel key from Voltages record.
+        """
+        idx = self.channel_index(key)
+        return voltages.current[idx], voltages.minimum[idx], voltages.maximum[idx]
+
+    def channels(self, voltages):
+        """
+        Return a list with an AdcChannel for every channel in Voltages record.
+        """
+        return [
+            AdcChannel(*channel) for channel in zip(
+                self.labels, voltages.current, voltages.minimum, voltages.maximum)]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return 'AdcChannelMap(%r)' % (self.labels, )
+
+
+def _ints(reply, count=None):
+    """
+    Return the values of reply (without the command code) as a tuple of ints.
+
+    Raise ValueError if a value is not an integer or there are not exactly
+    count values.
+    """
+    values = tuple(int(value) for value in reply[1:])
+    if count is not None and len(values) != count:
+        raise ValueError('%s: expected %d values, got %d' % (reply[0], count, len(values)))
+    return values
+
+
+def decode_voltages(reply):
+    values = _ints(reply)
+    num_labels, remainder = divmod(len(values), 3)
+    if remainder:
+        raise ValueError('$10: number of values is not a multiple of 3')
+    return Voltages(
+        values[:num_labels], values[num_labels:2*num_labels], values[2*num_labels:])
+
+
+def decode_status_error(reply):
+    return StatusError(*_ints(reply, 2))
+
+
+def decode_speed_direction(reply):
+    return SpeedDirection(*_ints(reply, 4))
+
+
+def decode_pid_parameters(reply):
+    return PIDParameters(*_ints(reply, 7))
+
+
+def decode_adc_labels(reply):
+    num_labels = int(reply[1])
+    labels = reply[2:]
+    if len(labels) != num_labels:
+        raise ValueError('$60: expected %d labels, got %d' % (num_labels, len(labels)))
+    return AdcChannelMap(labels)
+
+
+def decode_process_times(reply):
+    return ProcessTimes(_ints(reply))
+
+
+def decode_counters(reply):
+    return Counters(_ints(reply))
+
+
+# command code -> decode function
+DECODERS = {
+    '$10': decode_voltages,
+    '$11': decode_status_error,
+    '$13': decode_speed_direction,
+    '$50': decode_pid_parameters,
+    '$58': decode_process_times,
+    '$59': decode_counters,
+    '$60': decode_adc_labels,
+}
+
+
+# command code -> column names of the records that can be stored in columns
+# (see history.py and recorder.py). $10 columns depend on the adc channels.
+COLUMN_FIELDS = {
+    '$13': SpeedDirection._fields,
+    '$11': StatusError._fields,
+    '$10': None,
+}
+
+
+def voltages_fields(labels):
+    """
+    Return $10 column names for adc channel labels: <label>_current, ...
+
+    Column names must be unique: a label that is used for more than one channel
+    gets the channel index, <label>_<idx>_current.
+    """
+    labels = [str(label) for label in labels]
+    labels = [
+        label if labels.count(label) == 1 else '%s_%d' % (label, idx)
+        for idx, label in enumerate(labels)]
+    if len(set(labels)) != len(labels):
+        labels = [str(idx) for idx in range(len(labels))]
+    return tuple(
+        '%s_%s' % (label, field) for field in ('current', 'minimum', 'maximum')
+        for label in labels)
+
+
+def column_fields(code, num_fields, adc_labels=None):
+    """
+    Return column names for code with num_fields values. $10 columns use
+    adc_labels if they match, otherwise the channel index.
+    """
+    fields = COLUMN_FIELDS[code]
+    if fields is None:
+        if adc_labels is not None and 3 * len(adc_labels) == num_fields:
+            fields = voltages_fields(adc_labels)
+        else:
+            fields = voltages_fields(range(num_fields // 3))
+    return fields
+
+
+def record_row(code, record):
+    """
+    Return the values of a telemetry record as a flat tuple of ints.
+    """
+    if code == '$10':
+        return record.current + record.minimum + record.maximum
+    return tuple(record)
+
+
+def decode(reply):
+    """
+    Return the record for reply, or None if there is no decoder for it.
+
+    Raise ValueError if the reply cannot be decoded.
+    """
+    decoder = DECODERS.get(reply[0])
+    if decoder is None:
+        return None
+    return decoder(reply)
@@ -0,0 +1,144 @@
+"""
+Tests for the IOEngine serving several SWMs.
+
+    $ python3 -m unittest test_io_engine
+"""
+import concurrent.futures
+import time
+import unittest
+
+import connection
+
+from io_engine import IOEngine
+from swm import SWM
+
+
+def mock_connection(unique_address):
+    return connection.Connection.from_dict({
+        'connection_type': 'mock', 'name': 'test io engine %d' % unique_address,
+        'unique_address': unique_address})
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class IOEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_engine = IOEngine()
+        self.smart_wheels = [
+            SWM(mock_connection(idx + 1), poll_status=False, io_engine=self.io_engine)
+            for idx in range(2)]
+        for smart_wheel in self.smart_wheels:
+            smart_wheel.connect()
+
+    def tearDown(self):
+        for smart_wheel in self.smart_wheels:
+            smart_wheel.disconnect()
+            smart_wheel.shut_down()
+        self.io_engine.shut_down()
+        self.io_engine._thread.join(2)
+
+    def test_failing_wheel_does_not_stop_the_others(self):
+        failing, other = self.smart_wheels
+
+        def io_read(timeout=None):
+            raise RuntimeError('broken wheel')
+        failing.io_read = io_read
+
+        loops = self.io_engine.loop_counter
+        self.assertTrue(wait_for(lambda: self.io_engine.loop_counter > loops + 5))
+        self.assertTrue(self.io_engine._thread.is_alive())
+
+        future = other.command('$13', reply=True)
+        self.assertEqual(future.result(2)[0], '$13')
+
+
+class IdleEngine(object):
+    """
+    Stands in for an IOEngine: the test calls the io_ methods itself.
+    """
+
+    def add(self, smart_wheel):
+        pass
+
+    def remove(self, smart_wheel):
+        pass
+
+    def wakeup(self):
+        pass
+
+
+class IdleWheelTest(unittest.TestCase):
+    """
+    A connected wheel that only does I/O when the test calls the io_ methods.
+    """
+
+    def setUp(self):
+        self.smart_wheel = SWM(mock_connection(1), poll_status=False, io_engine=IdleEngine())
+        self.smart_wheel.connect()
+
+    def tearDown(self):
+        if self.smart_wheel.is_connected():
+            self.smart_wheel.disconnect()
+        self.smart_wheel.shut_down()
+
+    def test_poll_while_disconnecting(self):
+        def command(cmd, **kwargs):
+            # the connection is gone between is_connected and command
+            raise connection.NotConnectedException('disconnected')
+        self.smart_wheel.poll_status = True
+        self.smart_wheel.command = command
+        self.assertIsNone(self.smart_wheel.io_poll())
+
+    def test_queued_command_times_out(self):
+        future = self.smart_wheel.command('$13', reply=True, timeout=0.01)
+        time.sleep(0.02)
+        self.smart_wheel.expire_replies()
+        self.assertIsInstance(future.exception(0), concurrent.futures.TimeoutError)
+
+    def test_disconnect_fails_queued_commands(self):
+        future = self.smart_wheel.command('$13', reply=True)
+        self.smart_wheel.disconnect()
+        self.assertIsInstance(future.exception(0), connection.NotConnectedException)
+        self.assertEqual(len(self.smart_wheel.write_queue), 0)
+
+    def write_direct(self, cmd):
+        """
+        Return the codes of the replies, in the order the commands were written.
+        """
+        with self.smart_wheel.write_lock:
+            self.smart_wheel.write_direct(cmd)
+        frames = self.smart_wheel.connection.connection.read_frames()
+        return [frame.split(',', 1)[0] for frame in frames]
+
+    def test_write_direct_after_enable(self):
+        for cmd in ['$1', '$2,50,0', '$13']:
+            self.smart_wheel.command(cmd)
+        self.assertEqual(self.write_direct('$2,100,0'), ['$1', '$2'])
+        self.assertEqual(self.smart_wheel.write_queue.get().cmd, '$13')
+        self.assertEqual(len(self.smart_wheel.write_queue), 0)
+
+    def test_write_direct_after_disable(self):
+        for cmd in ['$13', '$0', '$1']:
+            self.smart_wheel.command(cmd)
+        self.assertEqual(self.write_direct('$2,100,0'), ['$0', '$1', '$2'])
+        self.assertEqual(len(self.smart_wheel.write_queue), 1)
+
+    def test_written_command_gets_reply(self):
+        future = self.smart_wheel.command('$13', reply=True)
+        self.smart_wheel.io_write()
+        self.assertTrue(wait_for(lambda: self.smart_wheel.io_read(timeout=0.1) or future.done()))
+        self.smart_wheel.expire_replies()
+        self.assertEqual(future.result(0)[0], '$13')
+        self.assertEqual(self.smart_wheel.queued_futures, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
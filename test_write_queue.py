@@ -0,0 +1,80 @@
+"""
+Tests for the order of commands in the WriteQueue.
+
+    $ python3 -m unittest test_write_queue
+"""
+import unittest
+
+from write_queue import WriteQueue, LANE_SAFETY
+
+
+def drain(write_queue):
+    result = []
+    item = write_queue.get()
+    while item is not None:
+        result.append(item.cmd)
+        item = write_queue.get()
+    return result
+
+
+class WriteQueueOrderTest(unittest.TestCase):
+
+    def test_disable_cancels_earlier_enable_and_setpoints(self):
+        write_queue = WriteQueue()
+        for cmd in ['$1', '$2,100,0', '$0', '$2,200,0']:
+            write_queue.put(cmd)
+        # the wheel must not be enabled after the disable
+        self.assertEqual(drain(write_queue), ['$0', '$2,200,0'])
+        self.assertEqual(write_queue.stats()['cancelled'], {'$1': 1, '$2': 1})
+
+    def test_reset_cancels_earlier_enable_and_setpoints(self):
+        write_queue = WriteQueue()
+        for cmd in ['$1', '$2,100,0', '$8']:
+            write_queue.put(cmd)
+        self.assertEqual(drain(write_queue), ['$8'])
+        self.assertEqual(write_queue.stats()['cancelled'], {'$1': 1, '$2': 1})
+
+    def test_enable_after_reset(self):
+        write_queue = WriteQueue()
+        for cmd in ['$8', '$1', '$2,100,0']:
+            write_queue.put(cmd)
+        self.assertEqual(drain(write_queue), ['$8', '$1', '$2,100,0'])
+
+    def test_enable_after_disable(self):
+        write_queue = WriteQueue()
+        for cmd in ['$0', '$1', '$2,100,0']:
+            write_queue.put(cmd)
+        self.assertEqual(drain(write_queue), ['$0', '$1', '$2,100,0'])
+
+    def test_enable_stays_before_setpoint(self):
+        write_queue = WriteQueue()
+        for cmd in ['$13', '$1', '$2,100,0', '$2,150,0']:
+            write_queue.put(cmd)
+        self.assertEqual(drain(write_queue), ['$1', '$2,150,0', '$13'])
+
+    def test_disable_cancels_futures(self):
+
+        class Future(object):
+            cancelled = False
+
+            def cancel(self):
+                self.cancelled = True
+
+        write_queue = WriteQueue()
+        future = Future()
+        write_queue.put('$1', future)
+        write_queue.put('$0')
+        self.assertTrue(future.cancelled)
+        self.assertEqual(drain(write_queue), ['$0'])
+
+    def test_get_safety_lane_only(self):
+        write_queue = WriteQueue()
+        for cmd in ['$13', '$0', '$2,100,0']:
+            write_queue.put(cmd)
+        self.assertEqual(write_queue.get(LANE_SAFETY).cmd, '$0')
+        self.assertIsNone(write_queue.get(LANE_SAFETY))
+        self.assertEqual(drain(write_queue), ['$2,100,0', '$13'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,7 +21,6 @@ import logging
 import threading
 import time
 import random
-import copy
 
 from swm import SWM
 
@@ -115,6 +114,8 @@ class WheelGUI(object):
         self.i_wanna_live = True
 
         self.initial_control_params = False
+        # version of the last SWM snapshot shown
+        self.snapshot_version = None
         # self.root.protocol("WM_DELETE_WINDOW", self.close())
 
         mainframe = ttk.Frame(self.root, padding="5 5 12 12")
@@ -226,19 +227,15 @@ class WheelGUI(object):
         self.adc_tree.heading("min", text="min")
         self.adc_tree.heading("max", text="max")
          
-        if (SWM.CMD_GET_ADC_LABELS in self.smart_wheel.cmd_from_wheel and
-           SWM.CMD_GET_VOLTAGES in self.smart_wheel.cmd_from_wheel):
-            # CMD_GET_ADC_LABELS returns "'$60', '8', 'Vin', '3V3', 'NC', 'Curr1', 'Curr2', 'Nc2', 'Nc3', 'NTC'"
-            num_labels = int(self.smart_wheel.cmd_from_wheel[SWM.CMD_GET_ADC_LABELS][1])
-            for i in range(num_labels):
-                label = self.smart_wheel.cmd_from_wheel[SWM.CMD_GET_ADC_LABELS][i+2]
-                adc = self.smart_wheel.cmd_from_wheel[SWM.CMD_GET_VOLTAGES]
+        adc_channels = self.smart_wheel.get_adc_channels()
+        if adc_channels:
+            for channel in adc_channels:
                 # initially set the values, but we change them later using update_adc_table
                 iid = self.adc_tree.insert(
                     "", "end", 
-                    text=label, 
-                    values=(adc[i+1], adc[i+num_labels+1], adc[i+num_labels*2+1]))
-                self.adc_iids[label] = iid  # set item id for later referral
+                    text=channel.label, 
+                    values=(channel.current, channel.minimum, channel.maximum))
+                self.adc_iids[channel.label] = iid  # set item id for later referral
         else:
             # no data from wheel
             self.adc_tree.insert("", "end", text="ADC", values=('n/a', 'n/a', 'n/a'))
@@ -252,17 +249,12 @@ class WheelGUI(object):
 
         self.adc_tree must be created using create_adc_table
         """
-        if (SWM.CMD_GET_ADC_LABELS in self.smart_wheel.cmd_from_wheel and
-           SWM.CMD_GET_VOLTAGES in self.smart_wheel.cmd_from_wheel):
-            # CMD_GET_ADC_LABELS returns "'$60', '8', 'Vin', '3V3', 'NC', 'Curr1', 'Curr2', 'Nc2', 'Nc3', 'NTC'"
-            num_labels = int(self.smart_wheel.cmd_from_wheel[SWM.CMD_GET_ADC_LABELS][1])
-            for i in range(num_labels):
-                label = self.smart_wheel.cmd_from_wheel[SWM.CMD_GET_ADC_LABELS][i+2]
-                adc = self.smart_wheel.cmd_from_wheel[SWM.CMD_GET_VOLTAGES]
-                # set the values
-                self.adc_tree.set(self.adc_iids[label], column=0, value=adc[i+1])  # avg
-                self.adc_tree.set(self.adc_iids[label], column=1, value=adc[i+num_labels+1])  # min
-                self.adc_tree.set(self.adc_iids[label], column=2, value=adc[i+num_labels*2+1])  # max
+        for channel in self.smart_wheel.get_adc_channels():
+            # set the values
+            iid = self.adc_iids[channel.label]
+            self.adc_tree.set(iid, column=0, value=channel.current)  # avg
+            self.adc_tree.set(iid, column=1, value=channel.minimum)  # min
+            self.adc_tree.set(iid, column=2, value=channel.maximum)  # max
 
     def reset_min_max_adc(self):
         """
@@ -284,10 +276,22 @@ class WheelGUI(object):
 
     def store_pid(self, param_idx, param_value):
         """
-        store a single PID value & send command $50 (get pid values) as well.
+        store a single PID value & send command $50 (get pid values) as soon as
+        the wheel confirmed.
         """
-        self.smart_wheel.command('$51,%s,%s' % (str(param_idx), param_value))
-        self.smart_wheel.command('$50')
+        future = self.smart_wheel.command(
+            '$51,%s,%s' % (str(param_idx), param_value), reply=True)
+        future.add_done_callback(self.store_pid_done)
+
+    def store_pid_done(self, future):
+        """
+        callback for the $51 reply: refresh the pid values (called from SWM thread)
+        """
+        try:
+            future.result()
+            self.smart_wheel.command('$50')
+        except Exception as ex:
+            self.smart_wheel.message('storing PID value failed: %s' % ex)
 
     def store_pid_fun(self, param_idx, entry_name):
         """
@@ -302,34 +306,40 @@ class WheelGUI(object):
         update gui from status of wheel
 
         !!only call from main thread!!
+
+        Nothing is done if nothing came in since the last call.
         """
-        # see if dict is sometimes changed during read
-        wheel_values = copy.deepcopy(self.smart_wheel.cmd_from_wheel)
+        # the snapshot does not change while we use it
+        snapshot = self.smart_wheel.snapshot
+        if snapshot.version == self.snapshot_version:
+            return
+        self.snapshot_version = snapshot.version
 
-        for cmd_response in wheel_values.values():
-            self.handle_cmd_from_wheel(cmd_response)
+        for code, cmd_response in snapshot.replies.items():
+            self.handle_cmd_from_wheel(cmd_response, snapshot.telemetry.get(code))
         self.update_adc_table()
 
     def set_control_params(self):
         """
         set GUI labels for all kinds of variables
         """
-        if '$50' not in self.smart_wheel.cmd_from_wheel:
+        pid = self.smart_wheel.telemetry.get('$50')
+        if pid is None:
             return
-        cmd = self.smart_wheel.cmd_from_wheel['$50']
-        self.smart_wheel.set_label('kpid-wheel-input', cmd[1])
-        self.smart_wheel.set_label('kpid-steer-input', cmd[2])
-        self.smart_wheel.set_label('ilim-wheel-input', cmd[3])
-        self.smart_wheel.set_label('ilim-steer-input', cmd[4])
-        self.smart_wheel.set_label('mae-offset-input', cmd[5])
-        self.smart_wheel.set_label('vin-min-input', cmd[6])
-        self.smart_wheel.set_label('module-address-input', cmd[7])
-
-    def handle_cmd_from_wheel(self, cmd):
+        self.smart_wheel.set_label('kpid-wheel-input', str(pid.kpid_wheel))
+        self.smart_wheel.set_label('kpid-steer-input', str(pid.kpid_steer))
+        self.smart_wheel.set_label('ilim-wheel-input', str(pid.ilim_wheel))
+        self.smart_wheel.set_label('ilim-steer-input', str(pid.ilim_steer))
+        self.smart_wheel.set_label('mae-offset-input', str(pid.mae_offset))
+        self.smart_wheel.set_label('vin-min-input', str(pid.vin_min))
+        self.smart_wheel.set_label('module-address-input', str(pid.module_address))
+
+    def handle_cmd_from_wheel(self, cmd, record=None):
         """
         update GUI labels according to given cmd.
 
-        cmd is a list with strings.
+        cmd is a reply: a tuple with strings, record is the decoded cmd (see 
+        telemetry.py), if available.
         """
         if cmd[0] == '$10':  # measurements, run $60 to find out number of measurements
             pass
@@ -360,23 +370,23 @@ class WheelGUI(object):
         elif cmd[0] == '$29':
             # firmware
             self.smart_wheel.set_label(self.LBL_FIRMWARE, self.smart_wheel.firmware)
-        elif cmd[0] == '$50':
-            self.smart_wheel.set_label('kpid-wheel-read', cmd[1])
-            self.smart_wheel.set_label('kpid-steer-read', cmd[2])
-            self.smart_wheel.set_label('ilim-wheel-read', cmd[3])
-            self.smart_wheel.set_label('ilim-steer-read', cmd[4])
-            self.smart_wheel.set_label('mae-offset-read', cmd[5])
-            self.smart_wheel.set_label('vin-min-read', cmd[6])
-            self.smart_wheel.set_label('module-address-read', cmd[7])
+        elif cmd[0] == '$50' and record is not None:
+            self.smart_wheel.set_label('kpid-wheel-read', str(record.kpid_wheel))
+            self.smart_wheel.set_label('kpid-steer-read', str(record.kpid_steer))
+            self.smart_wheel.set_label('ilim-wheel-read', str(record.ilim_wheel))
+            self.smart_wheel.set_label('ilim-steer-read', str(record.ilim_steer))
+            self.smart_wheel.set_label('mae-offset-read', str(record.mae_offset))
+            self.smart_wheel.set_label('vin-min-read', str(record.vin_min))
+            self.smart_wheel.set_label('module-address-read', str(record.module_address))
             if self.initial_control_params is False:
                 self.set_control_params()
                 self.initial_control_params = True
-        elif cmd[0] == '$58':
+        elif cmd[0] == '$58' and record is not None:
             # process times  4 numbers
-            self.smart_wheel.set_label('process-read', ' '.join(cmd[1:]))
-        elif cmd[0] == '$59':
+            self.smart_wheel.set_label('process-read', ' '.join(str(t) for t in record.times))
+        elif cmd[0] == '$59' and record is not None:
             # counters  3 numbers
-            self.smart_wheel.set_label('counters-read', ' '.join(cmd[1:]))
+            self.smart_wheel.set_label('counters-read', ' '.join(str(c) for c in record.counters))
 
 
 def wheel_gui(root, parent=None, smart_wheel=None,):
@@ -0,0 +1,248 @@
+"""
+WriteQueue: the queue with commands for the write thread of a SWM.
+
+The write thread waits on the queue instead of sleeping: a command that is
+put in the queue wakes it up immediately. Waiting with a timeout is used for
+the poll schedule.
+
+Commands are put in priority lanes, a lane is only served when all lanes
+before it are empty:
+
+- safety: disable ($0) and reset ($8)
+- motion: enable ($1) and setpoints ($2)
+- config: all other commands
+- telemetry: the polls from the SWM write thread
+
+Last-value-wins commands (COALESCE_CODES) are coalesced: if there is still an
+unsent command with the same code in the queue, it is replaced by the newest.
+
+A disable ($0) or reset ($8) goes out before everything else, so it drops the
+unsent enables and setpoints (CANCELLED_BY) that were put before it: they must
+not be executed after the disable or reset.
+"""
+import threading
+import time
+
+from collections import defaultdict, deque
+
+
+LANE_SAFETY = 0
+LANE_MOTION = 1
+LANE_CONFIG = 2
+LANE_TELEMETRY = 3
+
+LANE_NAMES = ('safety', 'motion', 'config', 'telemetry')
+
+# lane per command code, commands that are not in here go to LANE_CONFIG
+COMMAND_LANES = {
+    '$0': LANE_SAFETY,
+    '$8': LANE_SAFETY,
+    # enable must stay in order with the setpoints
+    '$1': LANE_MOTION,
+    '$2': LANE_MOTION,
+}
+
+
+# only the newest of these commands matters: setpoints, watchdog
+COALESCE_CODES = {'$2', '$16'}
+
+# command code -> codes of unsent commands that are dropped when it is put
+CANCELLED_BY = {
+    '$0': {'$1', '$2'},
+    '$8': {'$1', '$2'},
+}
+
+
+def command_code(cmd):
+    """
+    Return command code of cmd: '$2,100,0' -> '$2'
+    """
+    return cmd.split(',', 1)[0].strip()
+
+
+class WriteItem(object):
+    """
+    A command in the write queue.
+
+    future is an optional CommandFuture that gets the reply.
+    """
+    __slots__ = ('cmd', 'code', 'future', 'enqueued')
+
+    def __init__(self, cmd, future=None):
+        self.cmd = cmd
+        self.code = command_code(cmd)
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class LaneStats(object):
+    """
+    Wait times (from put until get) of a single lane, in seconds.
+    """
+    __slots__ = ('count', 'wait_total', 'wait_last', 'wait_max')
+
+    def __init__(self):
+        self.count = 0
+        self.wait_total = 0.0
+        self.wait_last = 0.0
+        self.wait_max = 0.0
+
+    def add(self, wait):
+        self.count += 1
+        self.wait_total += wait
+        self.wait_last = wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+
+
+class WriteQueue(object):
+    """
+    Thread safe priority queue: a deque per lane and a condition variable.
+    Within a lane, commands are first in first out.
+    """
+
+    def __init__(self):
+        self.lanes = tuple(deque() for lane in LANE_NAMES)
+        self.lane_stats = tuple(LaneStats() for lane in LANE_NAMES)
+        self.condition = threading.Condition()
+        # command code -> unsent WriteItem that can be coalesced
+        self.coalesce_items = {}
+        # command code -> number of commands that were replaced by a newer one
+        self.coalesced = defaultdict(int)
+        # command code -> number of commands dropped, see CANCELLED_BY
+        self.cancelled = defaultdict(int)
+
+    def put(self, cmd, future=None, lane=None):
+        """
+        Add cmd and wake up the writer.
+
+        lane: one of the LANE_ constants, default depends on the command code.
+
+        Commands in COALESCE_CODES replace an unsent command with the same code,
+        unless one of them waits for a reply (has a future). Commands in
+        CANCELLED_BY drop the unsent commands they cancel.
+        """
+        item = WriteItem(cmd, future)
+        if lane is None:
+            lane = COMMAND_LANES.get(item.code, LANE_CONFIG)
+        with self.condition:
+            cancels = CANCELLED_BY.get(item.code)
+            if cancels:
+                self._cancel(cancels)
+            if item.code in COALESCE_CODES and future is None:
+                queued = self.coalesce_items.get(item.code)
+                if queued is not None:
+                    # keep the place in the queue, send the newest value
+                    queued.cmd = cmd
+                    self.coalesced[item.code] += 1
+                    return
+                self.coalesce_items[item.code] = item
+            self.lanes[lane].append(item)
+            self.condition.notify()
+
+    def _cancel(self, codes):
+        """
+        Drop unsent commands with a code in codes, with the condition held.
+        Their futures are cancelled.
+        """
+        for queue in self.lanes:
+            if not any(item.code in codes for item in queue):
+                continue
+            kept = deque()
+            for item in queue:
+                if item.code not in codes:
+                    kept.append(item)
+                    continue
+                if self.coalesce_items.get(item.code) is item:
+                    del self.coalesce_items[item.code]
+                if item.future is not None:
+                    item.future.cancel()
+                self.cancelled[item.code] += 1
+            queue.clear()
+            queue.extend(kept)
+
+    def get(self, max_lane=LANE_TELEMETRY):
+        """
+        Return the next WriteItem, or None if the queue is empty. Does not block.
+
+        Only lanes up to and including max_lane are looked at, i.e.
+        get(LANE_SAFETY) only returns disables and resets.
+        """
+        with self.condition:
+            for lane, queue in enumerate(self.lanes[:max_lane + 1]):
+                if queue:
+                    item = queue.popleft()
+                    if self.coalesce_items.get(item.code) is item:
+                        del self.coalesce_items[item.code]
+                    self.lane_stats[lane].add(time.perf_counter() - item.enqueued)
+                    return item
+            return None
+
+    def wait(self, timeout=None):
+        """
+        Wait until there is something in the queue, at most timeout seconds.
+
+        Return True if there is something in the queue.
+        """
+        with self.condition:
+            if not any(self.lanes):
+                self.condition.wait(timeout)
+            return any(self.lanes)
+
+    def wakeup(self):
+        """
+        Wake up the writer without adding something, i.e. when shutting down.
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    def discard(self, code):
+        """
+        Remove the unsent command with code in COALESCE_CODES, i.e. when a newer
+        one is written directly (see SWM.write_direct). Counts as coalesced.
+
+        Return True if there was one.
+        """
+        with self.condition:
+            item = self.coalesce_items.pop(code, None)
+            if item is None:
+                return False
+            for queue in self.lanes:
+                if item in queue:
+                    queue.remove(item)
+                    break
+            self.coalesced[code] += 1
+            return True
+
+    def queued(self, code):
+        """
+        Return True if an unsent command with code is in the queue.
+        """
+        with self.condition:
+            return any(item.code == code for queue in self.lanes for item in queue)
+
+    def clear(self):
+        with self.condition:
+            for queue in self.lanes:
+                queue.clear()
+            self.coalesce_items.clear()
+
+    def stats(self):
+        """
+        Return dict with depth and wait times (seconds) per lane name, and the
+        number of coalesced and cancelled commands per command code.
+        """
+        result = {'coalesced': dict(self.coalesced), 'cancelled': dict(self.cancelled)}
+        with self.condition:
+            for name, queue, stats in zip(LANE_NAMES, self.lanes, self.lane_stats):
+                result[name] = {
+                    'depth': len(queue),
+                    'count': stats.count,
+                    'wait_last': stats.wait_last,
+                    'wait_max': stats.wait_max,
+                    'wait_mean': stats.wait_total / stats.count if stats.count else 0.0,
+                    }
+        return result
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.lanes)